@@ -0,0 +1,88 @@
+"""
+Radio Garden の局の一覧をフィクスチャから取り込み, 索引の構築と検索にかかる時間を計測する。
+
+    python -m bench.garden [--size 30000] [--fixture bench/fixtures/radio_garden.json]
+
+フィクスチャをスタンドインのサーバーから API と同じ形で配信し, 取得からパースまでも通して確認する。
+実際の一覧と同程度の規模にするため, フィクスチャの局を名前を変えて size 局まで複製してから索引を作る。
+"""
+
+import argparse
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import List
+
+from bot.app import App
+from bot.garden import GardenIndex, GardenStation, RadioGardenDirectory
+
+from bench.soak import StandInProcess, setup
+
+FIXTURE: str = "bench/fixtures/radio_garden.json"
+QUERIES: List[str] = ["bbc", "bbc radio 1", "jazz", "tokyo", "fm", "j-wave", "radio swiss", "zurisee", "sao paulo", "ｊａｚｚ", "no such station"]
+
+
+def scale(stations: List[GardenStation], size: int) -> List[GardenStation]:
+    # 同じ乱数の種から作り, 毎回同じ一覧で比べられるようにする
+    rng = random.Random(0)
+    words = sorted({w for x in stations for w in x.name.split()})
+
+    scaled = list(stations)
+    while len(scaled) < size:
+        base = stations[len(scaled) % len(stations)]
+        name = f"{base.name} {rng.choice(words)} {len(scaled)}"
+        scaled.append(GardenStation(id=f"x{len(scaled):07d}", name=name, country=base.country, place=f"{base.place} {len(scaled) % 997}", page=f"/listen/x/x{len(scaled):07d}"))
+
+    return scaled
+
+async def crawl(fixture: str) -> List[GardenStation]:
+    async with StandInProcess(0, None, 0, fixture):
+        return await RadioGardenDirectory.crawl()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=30000)
+    parser.add_argument("--fixture", default=FIXTURE)
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        setup(directory, False)
+        stations = App.client.loop.run_until_complete(crawl(args.fixture))
+
+    with open(args.fixture) as f:
+        expected = f.read().count('"page"')
+    print(f"crawled {len(stations)} stations from the stand-in (fixture has {expected})")
+    if len(stations) != expected:
+        sys.exit(1)
+
+    scaled = scale(stations, args.size)
+
+    started = time.perf_counter()
+    index = GardenIndex(scaled)
+    built = time.perf_counter() - started
+
+    # tracemalloc は構築を大きく遅くするので, メモリは別に作り直して測る
+    tracemalloc.start()
+    copy = GardenIndex(scaled)
+    memory = tracemalloc.get_traced_memory()[0]
+    del copy
+    tracemalloc.stop()
+    print(f"indexed {len(index)} stations in {built * 1000:.0f}ms ({memory / 2 ** 20:.1f} MiB)")
+
+    for query in QUERIES:
+        timings = []
+        for _ in range(args.rounds):
+            started = time.perf_counter()
+            results = index.search(query)
+            timings.append(time.perf_counter() - started)
+
+        top = results[0].name if results else "-"
+        print(f"{query!r:>20}: {statistics.median(timings) * 1000:7.3f}ms median, {max(timings) * 1000:7.3f}ms max, top: {top}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+PCMVolumeTransformer と LoudnessTransformer の 1 ストリームあたりの CPU 時間を比べる。
+
+    python -m bench.loudness [秒数]
+"""
+
+import sys
+import time
+from typing import Dict, List
+
+import numpy as np
+from discord import AudioSource, PCMVolumeTransformer
+from discord.opus import Encoder, OpusNotLoaded
+
+from bot.loudness import LoudnessTransformer
+
+ROUNDS: int = 5
+
+
+class NoiseSource(AudioSource):
+    # 音量が揺れる帯域雑音を, 事前に作ったフレームから繰り返し返す
+    def __init__(self, frames: int = 500):
+        rng = np.random.default_rng(0)
+        samples = rng.standard_normal((frames * Encoder.SAMPLES_PER_FRAME, Encoder.CHANNELS))
+        envelope = 0.05 + 0.3 * np.abs(np.sin(np.linspace(0, 20, len(samples))))[:, None]
+        pcm = (np.clip(samples * envelope, -1, 1) * 32767).astype(np.int16).tobytes()
+        self.frames = [pcm[i:i + Encoder.FRAME_SIZE] for i in range(0, len(pcm), Encoder.FRAME_SIZE)]
+        self.index = 0
+
+    def read(self) -> bytes:
+        self.index += 1
+        return self.frames[self.index % len(self.frames)]
+
+
+def measure(source: AudioSource, frames: int, encoder: Encoder = None) -> float:
+    started = time.process_time()
+    for _ in range(frames):
+        data = source.read()
+        if encoder:
+            encoder.encode(data, Encoder.SAMPLES_PER_FRAME)
+
+    return (time.process_time() - started) / frames
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 300
+    frames = int(seconds * 50)
+
+    try:
+        Encoder()
+        encode = True
+    except OpusNotLoaded:
+        encode = False
+        print("libopus not found, skipping opus encode.")
+
+    print(f"{frames} frames ({seconds:.0f}s of audio), best of {ROUNDS} interleaved rounds")
+    factories = (("PCMVolumeTransformer", PCMVolumeTransformer), ("LoudnessTransformer", LoudnessTransformer))
+
+    # 他のプロセスの影響を均すため, 交互に繰り返して最も速かった回を使う
+    alone: Dict[str, List[float]] = {name: [] for name, _ in factories}
+    encoded: Dict[str, List[float]] = {name: [] for name, _ in factories}
+    for _ in range(ROUNDS):
+        for name, factory in factories:
+            alone[name].append(measure(factory(NoiseSource(), volume=0.5), frames))
+            if encode:
+                encoded[name].append(measure(factory(NoiseSource(), volume=0.5), frames, Encoder()))
+
+    for name, _ in factories:
+        # 20ms ごとに 1 フレームなので, 1 フレームあたりの時間を 20ms で割ると 1 ストリームが使う CPU の割合になる
+        best = min(alone[name])
+        line = f"{name:>20}: {best * 1e6:7.1f} us/frame ({best / 0.02:6.2%} CPU)"
+        if encode:
+            best = min(encoded[name])
+            line += f", with opus encode {best * 1e6:7.1f} us/frame ({best / 0.02:6.2%} CPU)"
+
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,404 @@
+"""
+ローカルのスタンドインを相手に, 局数を増やしながら配信と番組情報の取得を計測する。
+
+    python -m bench.soak [--stations 1,5,10,25,50] [--duration 30] [--rounds 20] [--output result.json] [--baseline result.json]
+
+計測するもの:
+  - metadata: radiko の program/now と番組表, /aandg の取得とパースにかかる時間と CPU 時間
+  - hls: 5 秒のセグメントの HLS を ffmpeg とバッファを通して再生し, 遅いセグメントを挟んでもフレームを捨てず再起動しないこと
+  - streams: 最初の音声までの時間, 上流が切れてから音声が戻るまでの時間, 1 ストリームあたりの CPU と RSS
+
+ffmpeg がない環境では hls と streams を省略する。--baseline に前回の結果を渡すと, 悪化した項目を表示して終了コード 1 を返す。
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import aiohttp
+
+import bot.config
+import bot.state
+from bot.app import App, Bot
+from bot.config import Config, Station
+from bot.hub import BroadcastHub
+from bot.metrics import Metrics
+from bot.radiko import JST, RadikoApiClient, RadikoSchedule
+from bot.agqr import AgqrProgram
+from bot.session import Session
+from bot.state import State
+
+from bench import standins
+from bench.standins import FakeVoiceClient, LocalSession, generate_audio, generate_hls_audio
+
+# 結果の比較で悪化とみなす割合
+TOLERANCE: float = 0.2
+
+
+class StandInProcess:
+    def __init__(self, stations: int, audio: Optional[str], seed: int, garden: Optional[str] = None, hls_audio: Optional[str] = None):
+        self.args = ["--stations", str(stations), "--seed", str(seed)]
+        if audio:
+            self.args += ["--audio", audio]
+        if hls_audio:
+            self.args += ["--hls-audio", hls_audio]
+        if garden:
+            self.args += ["--garden", garden]
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.port = 0
+
+    async def __aenter__(self) -> StandInProcess:
+        self.process = await asyncio.create_subprocess_exec(sys.executable, "-m", "bench.standins", *self.args, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
+        self.port = int(await self.process.stdout.readline())
+        Session.session = LocalSession(self.port)
+
+        return self
+
+    async def __aexit__(self, *_):
+        await Session.close()
+        self.process.stdin.close()
+        await self.process.wait()
+
+    async def control(self, method: str, path: str) -> Any:
+        async with aiohttp.ClientSession() as session:
+            async with session.request(method, f"http://127.0.0.1:{self.port}/control/{path}") as response:
+                return await response.json()
+
+
+def cpu_and_rss(exclude: List[int]) -> Tuple[float, int]:
+    # 自プロセスと子孫 (ffmpeg) の CPU 時間 (秒) と RSS (バイト) を /proc から合計する
+    parents: Dict[int, int] = {}
+    for pid in os.listdir("/proc"):
+        if pid.isdigit():
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    parents[int(pid)] = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+
+    pids, found = {os.getpid()}, True
+    while found:
+        children = {pid for pid, ppid in parents.items() if ppid in pids and pid not in pids and pid not in exclude}
+        pids |= children
+        found = bool(children)
+
+    ticks, page = os.sysconf("SC_CLK_TCK"), os.sysconf("SC_PAGE_SIZE")
+    cpu, rss = 0.0, 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / ticks
+            rss += int(fields[21]) * page
+        except (OSError, IndexError, ValueError):
+            continue
+
+    return cpu, rss
+
+
+def reset():
+    # 局数ごとに前回の状態を持ち越さない
+    BroadcastHub.hubs.clear()
+    RadikoApiClient.clients.clear()
+    Metrics.values.clear()
+    Metrics.histograms.clear()
+    State.data = {}
+    App.players = {}
+
+def histogram_mean(name: str, **labels: str) -> float:
+    histogram = Metrics.histograms.get(name, {}).get(tuple(sorted(labels.items())))
+    if not histogram or not sum(histogram.counts):
+        return 0.0
+
+    return histogram.sum / sum(histogram.counts)
+
+
+async def measure_metadata(stations: int, rounds: int, seed: int) -> Dict[str, Any]:
+    reset()
+    async with StandInProcess(stations, None, seed) as standin:
+        api = RadikoApiClient.get("JP13")
+        await api.auth.login()
+        station_ids = [f"ST{i:02d}" for i in range(stations)]
+
+        # 各局の RadikoPlayer が同時に現在の番組を問い合わせる状況を, キャッシュを切らしながら繰り返す
+        now_wall, now_cpu = [], []
+        for _ in range(rounds):
+            api.now_expires = datetime.min.replace(tzinfo=JST)
+            wall, cpu = time.perf_counter(), time.process_time()
+            programs = await asyncio.gather(*(api.get_on_air(x) for x in station_ids))
+            now_wall.append(time.perf_counter() - wall)
+            now_cpu.append(time.process_time() - cpu)
+
+            if any(x is None for x in programs):
+                raise RuntimeError("program/now did not return every station.")
+
+        # 起動時と日付が変わったときには, 全局が番組表を取得する
+        wall, cpu = time.perf_counter(), time.process_time()
+        await asyncio.gather(*(RadikoSchedule(api, x).get_current() for x in station_ids))
+        timetable_wall, timetable_cpu = time.perf_counter() - wall, time.process_time() - cpu
+
+        agqr_wall = []
+        for _ in range(rounds):
+            wall = time.perf_counter()
+            await AgqrProgram.get_on_air()
+            agqr_wall.append(time.perf_counter() - wall)
+
+        requests = await standin.control("GET", "requests")
+
+    return {
+        "stations": stations,
+        "now_round_ms": statistics.median(now_wall) * 1e3,
+        "now_round_cpu_ms": statistics.median(now_cpu) * 1e3,
+        "now_requests_per_round": requests.get("/v3/program/now/{area}.xml", 0) / rounds,
+        "radiko_parse_ms": histogram_mean("radiobot_parse_seconds", source="radiko") * 1e3,
+        "timetable_all_ms": timetable_wall * 1e3,
+        "timetable_all_cpu_ms": timetable_cpu * 1e3,
+        "agqr_ms": statistics.median(agqr_wall) * 1e3,
+        "agqr_parse_ms": histogram_mean("radiobot_parse_seconds", source="agqr") * 1e3
+    }
+
+
+async def wait_until(predicate, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() >= deadline:
+            return False
+        await asyncio.sleep(0.1)
+
+    return True
+
+async def measure_hls(stations: int, duration: float, hls_audio: str, seed: int) -> Dict[str, Any]:
+    reset()
+    async with StandInProcess(0, None, seed, hls_audio=hls_audio) as standin:
+        sinks: List[FakeVoiceClient] = []
+        for i in range(stations):
+            # 実際と同じく HlsIngest から ffmpeg, バッファを通して再生する
+            station = Station.load({
+                "name": f"hls{i:02d}",
+                "module": 2,
+                "radio_garden_url": f"http://127.0.0.1:{standin.port}/hls/ST{i:02d}/master.m3u8",
+                "hls": True
+            }, {}, i)
+
+            player = App.add_player(station)
+            player.hub = BroadcastHub.get(station.stream_key)
+            await player.start()
+
+            sink = FakeVoiceClient()
+            player.hub.subscribe(sink)
+            sinks.append(sink)
+
+        try:
+            await wait_until(lambda: all(x.first_audio is not None for x in sinks), 60)
+            first_audio = [x.first_audio for x in sinks if x.first_audio is not None]
+
+            # 遅いセグメント (1 回目だけ遅いものと, 常に遅いもの) を 1 つずつ挟むまで再生し続ける
+            cpu, _ = cpu_and_rss([standin.process.pid])
+            started = time.monotonic()
+            await asyncio.sleep(max(duration, standins.HLS_SEGMENT_SECONDS * standins.HLS_SLOW_EVERY))
+            cpu_end, rss = cpu_and_rss([standin.process.pid])
+            elapsed = time.monotonic() - started
+
+            supervisors = [x.hub.supervisor for x in App.players.values()]
+            rings = [x.pipeline.buffer.ring for x in supervisors if x.pipeline]
+            overruns = sum(x.overruns for x in supervisors) + sum(x.overruns for x in rings)
+            underruns = sum(x.underruns for x in supervisors) + sum(x.underruns for x in rings)
+            restarts = sum(Metrics.values.get("radiobot_pipeline_restarts_total", {}).values())
+            gaps = [x for sink in sinks for x in sink.gaps]
+        finally:
+            for sink in sinks:
+                sink.stop()
+            for player in list(App.players.values()):
+                await player.remove()
+
+    # セグメントがまとめて届いても, 遅いセグメントを待っても, フレームを捨てたり再起動したりしてはいけない
+    if overruns or restarts:
+        raise RuntimeError(f"HLS ingest dropped {overruns} frames and restarted {restarts} times.")
+
+    return {
+        "stations": stations,
+        "first_audio_s": statistics.median(first_audio) if first_audio else None,
+        "first_audio_missing": stations - len(first_audio),
+        "underruns": underruns,
+        "gaps": len(gaps),
+        "gap_max_s": max(gaps, default=0.0),
+        "cpu_per_stream": (cpu_end - cpu) / elapsed / stations,
+        "rss_per_stream_mb": rss / stations / 2 ** 20
+    }
+
+async def measure_streams(stations: int, duration: float, audio: str, seed: int, passthrough: bool) -> Dict[str, Any]:
+    reset()
+    async with StandInProcess(stations, audio, seed) as standin:
+        sinks: List[FakeVoiceClient] = []
+        for i in range(stations):
+            # 局ごとに別の URL にして, ストリームを共有させない
+            station = Station.load({
+                "name": f"st{i:02d}",
+                "module": 2,
+                "radio_garden_url": f"http://127.0.0.1:{standin.port}/stream/ST{i:02d}",
+                "passthrough": passthrough
+            }, {}, i)
+
+            player = App.add_player(station)
+            player.hub = BroadcastHub.get(station.stream_key)
+            await player.start()
+
+            sink = FakeVoiceClient()
+            player.hub.subscribe(sink)
+            sinks.append(sink)
+
+        try:
+            await wait_until(lambda: all(x.first_audio is not None for x in sinks), 30)
+            first_audio = [x.first_audio for x in sinks if x.first_audio is not None]
+
+            # 起動直後の揺れが収まってから定常状態を測る
+            await asyncio.sleep(min(duration / 5, 5))
+            cpu, _ = cpu_and_rss([standin.process.pid])
+            started = time.monotonic()
+            await asyncio.sleep(duration)
+            cpu_end, rss = cpu_and_rss([standin.process.pid])
+            elapsed = time.monotonic() - started
+            underruns = sum(x.hub.supervisor.pipeline.buffer.ring.underruns for x in App.players.values() if x.hub.supervisor.pipeline)
+
+            # 上流を一斉に切り, 各局の音声が戻るまでの時間を測る
+            gaps = [len(x.gaps) for x in sinks]
+            await standin.control("POST", "drop")
+            await wait_until(lambda: all(len(x.gaps) > n for x, n in zip(sinks, gaps)), 60)
+            reconnect = [max(x.gaps[n:]) for x, n in zip(sinks, gaps) if len(x.gaps) > n]
+        finally:
+            for sink in sinks:
+                sink.stop()
+            for player in list(App.players.values()):
+                await player.remove()
+
+    return {
+        "stations": stations,
+        "first_audio_s": statistics.median(first_audio) if first_audio else None,
+        "first_audio_max_s": max(first_audio) if first_audio else None,
+        "first_audio_missing": stations - len(first_audio),
+        "reconnect_gap_s": statistics.median(reconnect) if reconnect else None,
+        "reconnect_gap_max_s": max(reconnect) if reconnect else None,
+        "reconnect_missing": stations - len(reconnect),
+        "cpu_per_stream": (cpu_end - cpu) / elapsed / stations,
+        "rss_per_stream_mb": rss / stations / 2 ** 20,
+        "underruns": underruns
+    }
+
+
+def setup(directory: str, verbose: bool):
+    # 実際の起動と同じく config.json から設定を読み, state.json は一時ディレクトリに書く
+    bot.config.CONFIG_PATH = os.path.join(directory, "config.json")
+    with open(bot.config.CONFIG_PATH, "w") as f:
+        # Radio Garden の一覧も一時ディレクトリに置き, 本物の API を取得しに行かない
+        json.dump({"token": "standin", "stations": [], "radio_garden_directory": os.path.join(directory, "radio_garden.json"), "radio_garden_refresh": 0}, f)
+    bot.state.STATE_PATH = os.path.join(directory, "state.json")
+
+    App.started = time.monotonic()
+    App.config = Config.load()
+    App.logger = logging.getLogger("RadioBot")
+    App.logger.setLevel(logging.INFO if verbose else logging.ERROR)
+    App.logger.addHandler(logging.StreamHandler())
+
+    # Discord には接続せず, Supervisor が参照するループと is_closed() のためだけに使う
+    App.client = Bot(App.config.prefix)
+    App.players = {}
+
+def compare(result: Dict[str, Any], baseline: Dict[str, Any]) -> List[str]:
+    # 値が大きいほど悪い項目だけを比べる
+    regressions = []
+    for section in ("metadata", "hls", "streams"):
+        previous = {x["stations"]: x for x in baseline.get(section, [])}
+        for current in result.get(section, []):
+            before = previous.get(current["stations"])
+            if not before:
+                continue
+
+            for key, value in current.items():
+                old = before.get(key)
+                if key == "stations" or not isinstance(value, (int, float)) or not isinstance(old, (int, float)):
+                    continue
+                if value > old * (1 + TOLERANCE) and value - old > 1e-3:
+                    regressions.append(f"{section}[{current['stations']}].{key}: {old:.3f} -> {value:.3f}")
+
+    return regressions
+
+async def run(args: argparse.Namespace, directory: str) -> Dict[str, Any]:
+    stations = [int(x) for x in args.stations.split(",")]
+    result: Dict[str, Any] = {
+        "environment": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count()
+        },
+        "parameters": {k: v for k, v in vars(args).items() if k not in ("output", "baseline")},
+        "metadata": []
+    }
+
+    for n in stations:
+        result["metadata"].append(await measure_metadata(n, args.rounds, args.seed))
+        print(json.dumps(result["metadata"][-1]), file=sys.stderr)
+
+    if not shutil.which("ffmpeg"):
+        print("ffmpeg not found, skipping hls and streams.", file=sys.stderr)
+        return result
+
+    hls_audio = generate_hls_audio(directory)
+    result["hls"] = []
+    for n in stations:
+        result["hls"].append(await measure_hls(n, args.duration, hls_audio, args.seed))
+        print(json.dumps(result["hls"][-1]), file=sys.stderr)
+
+    audio = generate_audio(directory)
+    result["streams"] = []
+    for n in stations:
+        result["streams"].append(await measure_streams(n, args.duration, audio, args.seed, args.passthrough))
+        print(json.dumps(result["streams"][-1]), file=sys.stderr)
+
+    return result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stations", default="1,5,10,25,50")
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--passthrough", action="store_true")
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("--output")
+    parser.add_argument("--baseline")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        setup(directory, args.verbose)
+        result = App.client.loop.run_until_complete(run(args, directory))
+
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f))
+        for line in regressions:
+            print(f"regression: {line}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,399 @@
+"""
+ベンチマーク用に radiko.jp, uniqueradio.jp, radio.garden, Discord と HLS の配信の代わりをするローカルの実装。
+
+スタンドインのサーバーは計測対象の CPU 時間に含まれないよう, 別のプロセスとして起動する。
+
+    python -m bench.standins --stations 10 [--audio standin.ogg] [--hls-audio standin.aac] [--garden bench/fixtures/radio_garden.json] [--seed 0]
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Set, Tuple
+from xml.sax.saxutils import escape
+
+import aiohttp
+from aiohttp import web
+from discord import AudioSource
+from yarl import URL
+
+from bot.radiko import JST
+
+# 上流のホストをスタンドインに向ける
+HOSTS: Set[str] = {"radiko.jp", "www.uniqueradio.jp", "radio.garden"}
+
+
+class StandIn:
+    def __init__(self, stations: int, audio: Optional[str] = None, garden: Optional[str] = None, seed: int = 0, hls_audio: Optional[str] = None):
+        self.stations = stations
+        self.audio = audio
+        self.adts_frames: List[bytes] = []
+        self.adts_rate = 0.0
+        if hls_audio:
+            self.load_adts(hls_audio)
+        self.places: Dict[str, Dict[str, Any]] = {}
+        if garden:
+            self.load_garden(garden)
+        self.random = random.Random(seed)
+        self.streams: Set[asyncio.Task] = set()
+        self.requests: Dict[str, int] = {}
+        self.segment_requests: Dict[Tuple[str, int], int] = {}
+        self.runner: Optional[web.AppRunner] = None
+        self.port = 0
+
+    @property
+    def station_ids(self) -> List[str]:
+        return [f"ST{i:02d}" for i in range(self.stations)]
+
+    async def start(self):
+        app = web.Application(middlewares=[self.count])
+        app.router.add_post("/v2/api/auth1_fms", self.auth1)
+        app.router.add_post("/v2/api/auth2_fms", self.auth2)
+        app.router.add_get("/v2/station/stream_multi/{station}.xml", self.stream_multi)
+        app.router.add_get("/v3/program/now/{area}.xml", self.program_now)
+        app.router.add_get("/v3/program/station/date/{date}/{station}.xml", self.program_date)
+        app.router.add_get("/aandg", self.aandg)
+        app.router.add_get("/api/ara/content/places", self.garden_places)
+        app.router.add_get("/api/ara/content/page/{place}/channels", self.garden_channels)
+        app.router.add_get("/stream/{name}", self.stream)
+        app.router.add_get("/hls/{name}/master.m3u8", self.hls_master)
+        app.router.add_get("/hls/{name}/media.m3u8", self.hls_media)
+        app.router.add_get("/hls/{name}/{sequence}.aac", self.hls_segment)
+        app.router.add_post("/control/drop", self.control_drop)
+        app.router.add_get("/control/requests", self.control_requests)
+
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.drop()
+        if self.runner:
+            await self.runner.cleanup()
+
+    def url(self, path: str) -> str:
+        return f"http://127.0.0.1:{self.port}{path}"
+
+    def drop(self):
+        # 配信中の接続をすべて切り, 上流の瞬断を再現する
+        for task in list(self.streams):
+            task.cancel()
+        self.streams.clear()
+
+    @web.middleware
+    async def count(self, request: web.Request, handler):
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource else request.path
+        self.requests[route] = self.requests.get(route, 0) + 1
+        return await handler(request)
+
+    async def control_drop(self, _: web.Request) -> web.Response:
+        dropped = len(self.streams)
+        self.drop()
+        return web.json_response({"dropped": dropped})
+
+    async def control_requests(self, _: web.Request) -> web.Response:
+        return web.json_response(self.requests)
+
+    async def auth1(self, _: web.Request) -> web.Response:
+        return web.Response(text="OK", headers={
+            "X-Radiko-AuthToken": "standin-token",
+            "X-Radiko-KeyOffset": "8",
+            "X-Radiko-KeyLength": "16"
+        })
+
+    async def auth2(self, _: web.Request) -> web.Response:
+        return web.Response(text="JP13,東京都,tokyo Japan\r\n")
+
+    async def stream_multi(self, request: web.Request) -> web.Response:
+        station = request.match_info["station"]
+        return web.Response(text=f'<?xml version="1.0" encoding="UTF-8"?><urls><item areafree="0">{escape(self.url(f"/stream/{station}"))}</item></urls>', content_type="application/xml")
+
+    async def program_now(self, _: web.Request) -> web.Response:
+        now = datetime.now(JST).replace(minute=0, second=0, microsecond=0)
+        stations = "".join(self.station_xml(x, now, 1) for x in self.station_ids)
+        return web.Response(text=f'<?xml version="1.0" encoding="UTF-8"?><radiko><stations>{stations}</stations></radiko>', content_type="application/xml")
+
+    async def program_date(self, request: web.Request) -> web.Response:
+        day = datetime.strptime(request.match_info["date"], "%Y%m%d").replace(hour=5, tzinfo=JST)
+        station = self.station_xml(request.match_info["station"], day, 24)
+        return web.Response(text=f'<?xml version="1.0" encoding="UTF-8"?><radiko><stations>{station}</stations></radiko>', content_type="application/xml")
+
+    def station_xml(self, station_id: str, start: datetime, hours: int) -> str:
+        programs = []
+        for i in range(hours):
+            ft, to = start + timedelta(hours=i), start + timedelta(hours=i + 1)
+            # 実際の番組情報と同程度の大きさにする
+            info = escape("<br />".join(f"番組情報 {station_id} {i} {self.random.random()}" for _ in range(20)))
+            programs.append(
+                f'<prog id="{station_id}{ft:%Y%m%d%H%M}" ft="{ft:%Y%m%d%H%M%S}" to="{to:%Y%m%d%H%M%S}" ftl="{ft:%H%M}" tol="{to:%H%M}" dur="3600">'
+                f"<title>{station_id} Program {i}</title><url>https://example.com/{station_id}/{i}</url><desc>説明</desc><info>{info}</info>"
+                f"<pfm>出演者</pfm><img>https://example.com/{station_id}/{i}.png</img></prog>"
+            )
+
+        return f'<station id="{station_id}"><name>{station_id} Radio</name><progs>{"".join(programs)}</progs></station>'
+
+    async def aandg(self, _: web.Request) -> web.Response:
+        hour = datetime.now(JST).hour
+        values = [f"Program {hour}", "", "https://www.agqr.jp", "説明<br>2 行目", "パーソナリティ", "", "", "曲名", "アーティスト"]
+        names = ["Program_name", "Program_img", "Program_link", "Program_text", "Program_personality", "Now_ad_image", "Now_ad_link", "Now_music", "Now_artist"]
+        return web.Response(text="\n".join(f"var {n} = '{v}';" for n, v in zip(names, values)))
+
+    def load_garden(self, path: str):
+        # 局の一覧のダンプを, 地点ごとにまとめて API と同じ形で返せるようにする
+        with open(path, "r") as f:
+            stations = json.load(f)["stations"]
+
+        places: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        for station in stations:
+            key = (station["place"], station["country"])
+            if key not in places:
+                places[key] = {"id": f"P{len(places):05d}", "title": station["place"], "country": station["country"], "channels": []}
+            places[key]["channels"].append(station)
+
+        self.places = {x["id"]: x for x in places.values()}
+
+    async def garden_places(self, _: web.Request) -> web.Response:
+        return web.json_response({"apiVersion": 1, "data": {"list": [
+            {"id": x["id"], "title": x["title"], "country": x["country"], "geo": [0, 0], "size": len(x["channels"]), "url": f"/visit/{x['id']}"}
+            for x in self.places.values()
+        ]}})
+
+    async def garden_channels(self, request: web.Request) -> web.Response:
+        place = self.places.get(request.match_info["place"])
+        if not place:
+            raise web.HTTPNotFound()
+
+        items = [
+            {"page": {"type": "channel", "url": x["page"], "title": x["name"], "place": {"id": place["id"], "title": place["title"]}, "country": {"title": place["country"]}}}
+            for x in place["channels"]
+        ]
+        return web.json_response({"apiVersion": 1, "data": {"title": place["title"], "content": [{"title": f"Popular in {place['title']}", "items": items}]}})
+
+    async def stream(self, request: web.Request) -> web.StreamResponse:
+        if not self.audio:
+            raise web.HTTPNotFound()
+
+        response = web.StreamResponse(headers={"Content-Type": "audio/ogg"})
+        await response.prepare(request)
+        task = asyncio.current_task()
+        self.streams.add(task)
+
+        # 事前に生成した音声を実時間と同じ速さで繰り返し送る
+        with open(self.audio, "rb") as f:
+            data = f.read()
+        rate = len(data) / AUDIO_SECONDS
+        chunk = int(rate / 10)
+
+        try:
+            started, sent = time.monotonic(), 0
+            while True:
+                for i in range(0, len(data), chunk):
+                    await response.write(data[i:i + chunk])
+                    sent += chunk
+                    await asyncio.sleep(max(started + sent / rate - time.monotonic(), 0))
+        except (asyncio.CancelledError, ConnectionResetError):
+            pass
+        finally:
+            self.streams.discard(task)
+
+        return response
+
+    async def hls_master(self, _: web.Request) -> web.Response:
+        return web.Response(text="#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=48000,CODECS=\"mp4a.40.5\"\nmedia.m3u8\n", content_type="application/vnd.apple.mpegurl")
+
+    async def hls_media(self, _: web.Request) -> web.Response:
+        # 実時間に合わせてメディアシーケンスを進め, 直近の HLS_WINDOW 個のセグメントだけを並べる
+        newest = hls_sequence()
+        first = max(newest - HLS_WINDOW + 1, 0)
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", f"#EXT-X-TARGETDURATION:{HLS_SEGMENT_SECONDS:g}", f"#EXT-X-MEDIA-SEQUENCE:{first}"]
+        for sequence in range(first, newest + 1):
+            lines += [f"#EXTINF:{HLS_SEGMENT_SECONDS:.3f},", f"{sequence}.aac"]
+
+        return web.Response(text="\n".join(lines) + "\n", content_type="application/vnd.apple.mpegurl")
+
+    def load_adts(self, path: str):
+        # ADTS のフレームに分けておき, セグメントの長さに合わせて切り出す
+        with open(path, "rb") as f:
+            data = f.read()
+
+        i = 0
+        while i + 7 <= len(data):
+            length = ((data[i + 3] & 0x03) << 11) | (data[i + 4] << 3) | (data[i + 5] >> 5)
+            self.adts_frames.append(data[i:i + length])
+            i += length
+
+        rates = [96000, 88200, 64000, 48000, 44100, 32000, 24000, 22050, 16000, 12000, 11025, 8000, 7350]
+        self.adts_rate = rates[(data[2] >> 2) & 0x0f] / 1024
+
+    async def hls_segment(self, request: web.Request) -> web.Response:
+        name, sequence = request.match_info["name"], int(request.match_info["sequence"])
+        if not self.adts_frames or sequence > hls_sequence():
+            raise web.HTTPNotFound()
+
+        attempt = self.segment_requests.get((name, sequence), 0)
+        self.segment_requests[(name, sequence)] = attempt + 1
+
+        # 一部のセグメントは最初の取得だけ, または毎回応答を遅らせる
+        if sequence % HLS_SLOW_EVERY == HLS_SLOW_ONCE and attempt == 0 or sequence % HLS_SLOW_EVERY == HLS_SLOW_ALWAYS:
+            await asyncio.sleep(HLS_SLOW_SECONDS)
+
+        # 壁時計の位置に対応するフレームを, 音声を繰り返しながら切り出す
+        start, end = (int(x * HLS_SEGMENT_SECONDS * self.adts_rate) for x in (sequence, sequence + 1))
+        body = b"".join(self.adts_frames[i % len(self.adts_frames)] for i in range(start, end))
+        return web.Response(body=body, content_type="audio/aac")
+
+
+AUDIO_SECONDS: int = 60
+
+# radiko と同じく 5 秒のセグメントにする
+HLS_SEGMENT_SECONDS: float = 5
+HLS_WINDOW: int = 6
+# HlsIngest.segment_timeout (10 秒) より遅らせる
+HLS_SLOW_SECONDS: float = 12
+# 1 分ごとに, 取り直せば間に合うセグメントと, 常に間に合わないセグメントを 1 つずつ置く
+HLS_SLOW_EVERY: int = 12
+HLS_SLOW_ONCE: int = 2
+HLS_SLOW_ALWAYS: int = 8
+
+def hls_sequence() -> int:
+    # プロセスをまたいでも同じ番号になるよう, 壁時計から現在の最新のセグメントを決める
+    return int(time.time() / HLS_SEGMENT_SECONDS)
+
+async def serve(stations: int, audio: Optional[str], garden: Optional[str], seed: int, hls_audio: Optional[str]):
+    standin = StandIn(stations, audio, garden, seed, hls_audio)
+    await standin.start()
+
+    # 起動した側はこの行からポートを受け取る
+    print(standin.port, flush=True)
+
+    # 起動した側のプロセスが終わる (標準入力が閉じる) まで動かし続ける
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, sys.stdin.read)
+    await standin.stop()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stations", type=int, default=1)
+    parser.add_argument("--audio")
+    parser.add_argument("--hls-audio")
+    parser.add_argument("--garden")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    asyncio.run(serve(args.stations, args.audio, args.garden, args.seed, args.hls_audio))
+
+def generate_audio(directory: str) -> str:
+    # ffmpeg で 1 分間の正弦波を Ogg Opus として生成する
+    path = os.path.join(directory, "standin.ogg")
+    if not os.path.exists(path):
+        subprocess.run([
+            "ffmpeg", "-y", "-loglevel", "error", "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=48000:duration={AUDIO_SECONDS}",
+            "-ac", "2", "-c:a", "libopus", "-b:a", "128k", path
+        ], check=True)
+
+    return path
+
+def generate_hls_audio(directory: str) -> str:
+    # HLS のセグメント用に, 同じ正弦波を ADTS の AAC として生成する
+    path = os.path.join(directory, "standin.aac")
+    if not os.path.exists(path):
+        subprocess.run([
+            "ffmpeg", "-y", "-loglevel", "error", "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=48000:duration={AUDIO_SECONDS}",
+            "-ac", "2", "-c:a", "aac", "-b:a", "64k", "-f", "adts", path
+        ], check=True)
+
+    return path
+
+
+class LocalSession:
+    # Session.get() の代わりに置き, 上流のホストへのリクエストをスタンドインに送る
+    def __init__(self, port: int):
+        self.port = port
+        self.session = aiohttp.ClientSession()
+
+    def rewrite(self, url) -> URL:
+        url = URL(str(url))
+        if url.host in HOSTS:
+            return url.with_scheme("http").with_host("127.0.0.1").with_port(self.port)
+        return url
+
+    def get(self, url, **kwargs):
+        return self.session.get(self.rewrite(url), **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.session.post(self.rewrite(url), **kwargs)
+
+    @property
+    def closed(self) -> bool:
+        return self.session.closed
+
+    async def close(self):
+        await self.session.close()
+
+
+class FakeVoiceClient:
+    # discord.py の AudioPlayer と同じく 20ms ごとに読み出し, 音声が届いた時刻と途切れを記録する
+    interval: float = 0.02
+    # これより大きい Opus パケットを音声とみなす (無音のパケットは数バイトしかない)
+    threshold: int = 16
+
+    def __init__(self):
+        self.source: Optional[AudioSource] = None
+        self.thread: Optional[threading.Thread] = None
+        self.stopped = threading.Event()
+
+        self.started = 0.0
+        self.first_audio: Optional[float] = None
+        self.frames = 0
+        self.gaps: List[float] = []
+        self.silence_since: Optional[float] = None
+
+    def play(self, source: AudioSource):
+        self.source = source
+        self.started = time.monotonic()
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.source:
+            self.source.cleanup()
+
+    def is_playing(self) -> bool:
+        return self.thread is not None and not self.stopped.is_set()
+
+    def run(self):
+        deadline = time.perf_counter()
+        while not self.stopped.is_set():
+            data = self.source.read()
+            now = time.monotonic()
+            self.frames += 1
+
+            if len(data) > self.threshold:
+                if self.first_audio is None:
+                    self.first_audio = now - self.started
+                if self.silence_since is not None:
+                    self.gaps.append(now - self.silence_since)
+                    self.silence_since = None
+            elif self.first_audio is not None and self.silence_since is None:
+                self.silence_since = now
+
+            deadline += self.interval
+            time.sleep(max(deadline - time.perf_counter(), 0))
+
+
+if __name__ == "__main__":
+    main()
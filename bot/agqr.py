@@ -1,104 +1,81 @@
 from __future__ import annotations
 
 import asyncio
-import logging
 import re
-import time
 import urllib.parse
 from dataclasses import dataclass
 from datetime import datetime
-from subprocess import PIPE, Popen
-from threading import Thread
-from typing import Optional
+from typing import List, Optional
 
-import aiohttp
-from discord import (Embed, FFmpegPCMAudio, PCMVolumeTransformer, Streaming,
-                     TextChannel, VoiceChannel, VoiceClient)
-from discord.ext import commands
+from discord import Embed
 
 from bot.app import App
+from bot.audio import ffmpeg_output_args
+from bot.metrics import Metrics
+from bot.pipeline import Pipeline
+from bot.player import RadioPlayer
+from bot.resolver import StreamResolver
+from bot.session import Session
+from bot.state import State
 
 
-class AgqrPlayer(commands.Cog):
-    voice: VoiceClient
-    voice_channel: VoiceChannel
-    text_channel: Optional[TextChannel]
+class AgqrPlayer(RadioPlayer):
+    nick = "超A&G+"
+    avatar = "resources/agqr.png"
 
-    @commands.Cog.listener()
-    async def on_ready(self):
-        App.logger.debug("Agqr module loaded.")
+    urls = [
+        "rtmp://fms-base2.mitene.ad.jp/agqr/aandg333",
+        "rtmp://fms-base1.mitene.ad.jp/agqr/aandg333"
+    ]
 
-        if App.config.text_channel_id:
-            self.text_channel = App.client.get_channel(App.config.text_channel_id)
-        self.voice_channel = App.client.get_channel(App.config.voice_channel_id)
+    async def prepare(self):
+        self.resolver = StreamResolver(self.station.name, "agqr", self.get_urls, 24 * 60 * 60)
 
-        try:
-            member = self.voice_channel.guild.get_member(App.client.user.id)
-            if member.nick != "超A&G+":
-                await member.edit(nick="超A&G+")
-                with open("resources/agqr.png", "rb") as f:
-                    await App.client.user.edit(avatar=f.read())
-        except Exception as e:
-            logging.exception("Failed to change nickname or avatar.", exc_info=e)
+    async def get_urls(self) -> List[str]:
+        return self.urls
 
-        # バグ対応のため, 一度接続して切断する
-        await (await self.voice_channel.connect()).disconnect()
-        self.voice = await self.voice_channel.connect()
+    async def player(self) -> Pipeline:
+        url = await self.resolver.resolve()
 
-        Thread(target=self.player).start()
-        App.client.loop.create_task(self.update())
+        volume = self.station.volume
+        passthrough = self.station.passthrough
 
-    def player(self):
-        url = "rtmp://fms-base2.mitene.ad.jp/agqr/aandg333"
+        pipeline = await Pipeline.spawn([
+            ["rtmpdump", "--live", "-r", url],
+            ["ffmpeg", "-i", "-", *ffmpeg_output_args(passthrough, volume)]
+        ], passthrough, volume)
+        pipeline.upstream = url
 
-        while App.client.loop.is_running():
-            with Popen(["rtmpdump", "--live", "-r", url], stdout=PIPE) as p:
-                source = PCMVolumeTransformer(FFmpegPCMAudio(p.stdout, pipe=True), volume=App.config.volume)
-                self.voice.play(source, after=lambda _: p.kill())
-                p.wait()
-
-            time.sleep(5)
+        return pipeline
 
     async def update(self):
-        last_program_name = None
-        last_message = None
-
-        async for message in self.text_channel.history(limit=10):
-            if message.author == App.client.user:
-                last_message = message
-                break
+        last_program_name = State.get(self.station.name, "program")
 
         while App.client.loop.is_running():
             program = await AgqrProgram.get_on_air()
 
             if program.name != last_program_name:
+                self.split_recording()
+
                 if self.text_channel:
-                    async with self.text_channel.typing():
-                        embed = Embed(
-                            title=program.name,
-                            description=program.description,
-                            url=program.link_url or "https://www.agqr.jp",
-                            color=0xe30067,
-                            timestamp=datetime.utcnow()
-                        )
-                        embed.set_author(
-                            name=program.personality if program.personality else "文化放送",
-                            url=program.link_url or "https://www.agqr.jp"
-                        )
-
-                        if last_message:
-                            await last_message.edit(embed=embed)
-                        else:
-                            last_message = await self.text_channel.send(embed=embed)
-
-                await App.client.change_presence(
-                    activity=Streaming(
-                        name=program.name,
-                        url="https://twitch.tv/slashnephy"
+                    embed = Embed(
+                        title=program.name,
+                        description=program.description,
+                        url=program.link_url or "https://www.agqr.jp",
+                        color=0xe30067,
+                        timestamp=datetime.utcnow()
                     )
-                )
+                    embed.set_author(
+                        name=program.personality if program.personality else "文化放送",
+                        url=program.link_url or "https://www.agqr.jp"
+                    )
+
+                    self.post(embed)
+
+                self.set_presence(program.name)
 
                 last_program_name = program.name
+                State.set(self.station.name, "program", program.name)
 
             await asyncio.sleep(30)
 
@@ -116,31 +93,33 @@ class AgqrProgram:
 
     @classmethod
     async def get_on_air(cls) -> AgqrProgram:
-        async with aiohttp.ClientSession() as session:
-            headers = {
-                "Accept": "*/*",
-                "Accept-Encoding": "gzip, deflate",
-                "Accept-Language": "ja",
-                "Cache-Control": "max-age=0",
-                "Referer": "http://www.uniqueradio.jp/agplayerf/player3.php",
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/59.0.3071.115 Safari/537.36"
-            }
-
-            async with session.get("https://www.uniqueradio.jp/aandg", headers=headers) as response:
+        headers = {
+            "Accept": "*/*",
+            "Accept-Encoding": "gzip, deflate",
+            "Accept-Language": "ja",
+            "Cache-Control": "max-age=0",
+            "Referer": "http://www.uniqueradio.jp/agplayerf/player3.php",
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/59.0.3071.115 Safari/537.36"
+        }
+
+        with Metrics.timer("radiobot_metadata_poll_seconds", source="agqr"):
+            async with Session.get().get("https://www.uniqueradio.jp/aandg", headers=headers) as response:
                 text = await response.text()
-                t = [
-                    urllib.parse.unquote(re.sub("^.+?'(.*)';$", r"\1", line))
-                    for line in text.splitlines()
-                ]
-
-                return AgqrProgram(
-                    name=t[0],
-                    img_url=t[1] if t[1] else None,
-                    link_url=t[2] if t[2] else None,
-                    description=re.sub("<.+?>", "", t[3].replace("<br>", "\n")) if t[3] else None,
-                    personality=t[4] if t[4] else None,
-                    ad_img_url=t[5] if t[5] else None,
-                    ad_link_url=t[6] if t[6] else None,
-                    music_title=t[7] if t[7] else None,
-                    music_artist=t[8] if t[8] else None
-                )
+
+        with Metrics.timer("radiobot_parse_seconds", source="agqr"):
+            t = [
+                urllib.parse.unquote(re.sub("^.+?'(.*)';$", r"\1", line))
+                for line in text.splitlines()
+            ]
+
+            return AgqrProgram(
+                name=t[0],
+                img_url=t[1] if t[1] else None,
+                link_url=t[2] if t[2] else None,
+                description=re.sub("<.+?>", "", t[3].replace("<br>", "\n")) if t[3] else None,
+                personality=t[4] if t[4] else None,
+                ad_img_url=t[5] if t[5] else None,
+                ad_link_url=t[6] if t[6] else None,
+                music_title=t[7] if t[7] else None,
+                music_artist=t[8] if t[8] else None
+            )
@@ -1,19 +1,42 @@
+from __future__ import annotations
+
 import logging
+import time
+from typing import TYPE_CHECKING, Dict
 
 from discord import Status, Game
 from discord.ext import commands
 
-from .config import Config, Module
+from .config import Config, Module, Station
+
+if TYPE_CHECKING:
+    from .player import RadioPlayer
+
+class Bot(commands.Bot):
+    async def close(self):
+        from .metrics import Metrics
+        from .session import Session
+        from .state import State
+        await Metrics.stop()
+        await Session.close()
+        State.save()
+        await super().close()
 
 class App:
     config: Config
     logger: logging.Logger
-    client: commands.Bot
+    client: Bot
+    players: Dict[str, RadioPlayer]
+    started: float
 
     @classmethod
     def run(cls):
+        cls.started = time.monotonic()
         cls.config = Config.load()
 
+        from .state import State
+        State.load()
+
         cls.logger = logging.getLogger("RadioBot")
         cls.logger.setLevel(logging.INFO)
 
@@ -25,18 +48,39 @@ class App:
         if cls.config.debug:
             cls.logger.setLevel(logging.DEBUG)
 
-        cls.client = commands.Bot(cls.config.prefix)
+        cls.client = Bot(cls.config.prefix)
+
+        cls.players = {}
+        for station in cls.config.stations:
+            cls.add_player(station)
+
+        from .controls import Controls
+        cls.client.add_cog(Controls())
+
+        from .watcher import ConfigWatcher
+        cls.client.loop.create_task(ConfigWatcher().run())
+
+        if cls.config.metrics_port:
+            from .metrics import Metrics
+            cls.client.loop.create_task(Metrics.start(cls.config.metrics_port))
 
-        if cls.config.module == Module.Radiko:
+        cls.logger.info("Initialized.")
+
+        cls.client.run(cls.config.token)
+
+    @classmethod
+    def add_player(cls, station: Station) -> RadioPlayer:
+        if station.module == Module.Radiko:
             from .radiko import RadikoPlayer
-            cls.client.add_cog(RadikoPlayer())
-        elif cls.config.module == Module.Agqr:
+            player = RadikoPlayer(station)
+        elif station.module == Module.Agqr:
             from .agqr import AgqrPlayer
-            cls.client.add_cog(AgqrPlayer())
-        elif cls.config.module == Module.RadioGarden:
+            player = AgqrPlayer(station)
+        else:
             from .rgb import RadioGardenPlayer
-            cls.client.add_cog(RadioGardenPlayer())
+            player = RadioGardenPlayer(station)
 
-        cls.logger.info("Initialized.")
+        cls.client.add_cog(player)
+        cls.players[station.name] = player
 
-        cls.client.run(cls.config.token)
+        return player
@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+import asyncio
+from typing import AsyncIterator, List
+
+from discord import AudioSource, PCMVolumeTransformer
+from discord.opus import Decoder, Encoder
+
+# 無音の Opus フレーム
+OPUS_SILENCE = b"\xf8\xff\xfe"
+PCM_SILENCE = bytes(Encoder.FRAME_SIZE)
+
+
+async def read_ogg_packets(reader: asyncio.StreamReader) -> AsyncIterator[bytes]:
+    packet = b""
+    while True:
+        header = await reader.readexactly(27)
+        if header[:4] != b"OggS":
+            raise ValueError("Invalid Ogg page.")
+
+        segments = await reader.readexactly(header[26])
+        body = await reader.readexactly(sum(segments))
+
+        offset = 0
+        for length in segments:
+            packet += body[offset:offset + length]
+            offset += length
+
+            if length < 255:
+                # OpusHead / OpusTags はヘッダなので送らない
+                if not packet.startswith((b"OpusHead", b"OpusTags")):
+                    yield packet
+                packet = b""
+
+def ffmpeg_output_args(passthrough: bool, volume: float) -> List[str]:
+    if passthrough:
+        return ["-filter:a", f"volume={volume}", "-f", "opus", "-c:a", "libopus", "-ar", str(Encoder.SAMPLING_RATE), "-ac", str(Encoder.CHANNELS), "-b:a", "128k", "-loglevel", "warning", "pipe:1"]
+
+    return ["-f", "s16le", "-ar", str(Encoder.SAMPLING_RATE), "-ac", str(Encoder.CHANNELS), "-loglevel", "warning", "pipe:1"]
+
+def output_source(source: AudioSource, volume: float, normalize: bool) -> AudioSource:
+    if source.is_opus():
+        return source
+
+    if normalize:
+        from bot.loudness import LoudnessTransformer
+        return LoudnessTransformer(source, volume=volume)
+
+    return PCMVolumeTransformer(source, volume=volume)
+
+
+class OpusDecoder(AudioSource):
+    def __init__(self, original: AudioSource):
+        self.original = original
+        self.decoder = Decoder()
+
+    def read(self) -> bytes:
+        data = self.original.read()
+        if not data:
+            return b""
+
+        return self.decoder.decode(data)
+
+    def cleanup(self):
+        self.original.cleanup()
+
+def apply_volume(source: AudioSource, volume: float, baked: float) -> AudioSource:
+    if isinstance(source, PCMVolumeTransformer):
+        if not isinstance(source.original, OpusDecoder):
+            source.volume = volume
+            return source
+
+        # 焼き込んだ音量に戻ったら, デコードをやめて Opus のまま送る
+        if volume == baked:
+            return source.original.original
+
+        source.volume = volume / baked
+        return source
+
+    # ffmpeg で音量を焼き込んだ Opus は, 違う音量のときだけデコードして掛け直す
+    if source.is_opus() and volume != baked and baked:
+        return PCMVolumeTransformer(OpusDecoder(source), volume=volume / baked)
+
+    return source
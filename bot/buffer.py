@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+import threading
+import time
+from typing import List, Optional
+
+from discord import AudioSource
+from discord.opus import Encoder
+
+from bot.audio import OPUS_SILENCE, PCM_SILENCE
+
+
+class RingBuffer:
+    def __init__(self, capacity: int, slot_size: int = Encoder.FRAME_SIZE):
+        self.capacity = capacity
+        self.slot_size = slot_size
+        self.buffer = bytearray(capacity * slot_size)
+        # スライスでコピーを作らずにスロットを参照する
+        self.view = memoryview(self.buffer)
+        self.lengths: List[int] = [0] * capacity
+        self.head = 0
+        self.tail = 0
+        self.underruns = 0
+        self.overruns = 0
+        self.received = 0
+        self.last_received = time.monotonic()
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self.tail - self.head
+
+    def push(self, data: bytes):
+        with self.lock:
+            # 溢れた場合は最も古いフレームを捨てて遅延を抑える
+            if self.tail - self.head >= self.capacity:
+                self.head += 1
+                self.overruns += 1
+
+            index = self.tail % self.capacity
+            offset = index * self.slot_size
+            length = min(len(data), self.slot_size)
+            self.buffer[offset:offset + length] = data[:length]
+            self.lengths[index] = length
+            self.tail += 1
+
+        self.received += len(data)
+        self.last_received = time.monotonic()
+
+    def close(self):
+        self.closed = True
+
+    def trim(self, length: int):
+        with self.lock:
+            self.head = max(self.head, self.tail - length)
+
+    def pop(self) -> Optional[bytes]:
+        with self.lock:
+            if self.tail == self.head:
+                self.underruns += 1
+                return None
+
+            index = self.head % self.capacity
+            offset = index * self.slot_size
+            self.head += 1
+
+            # ハブが送信済みのフレームを保持し, スロットはすぐ上書きされるので, コピーは 1 回だけ作る
+            return bytes(self.view[offset:offset + self.lengths[index]])
+
+
+class BufferedSource(AudioSource):
+    def __init__(self, ring: RingBuffer, depth: int, opus: bool):
+        self.ring = ring
+        self.depth = min(depth, ring.capacity)
+        # 待機中の接続に切り替えるときに残すフレーム数
+        self.backlog = self.depth
+        self.opus = opus
+        self.silence = OPUS_SILENCE if opus else PCM_SILENCE
+        self.filling = True
+        self.started: Optional[float] = None
+
+    @property
+    def eof(self) -> bool:
+        return self.ring.closed
+
+    def feed(self, data: bytes):
+        self.ring.push(data)
+
+    def close(self):
+        self.ring.close()
+
+    def read(self) -> bytes:
+        if self.filling:
+            if len(self.ring) < self.depth and not self.eof:
+                return self.silence
+            self.filling = False
+            if self.started is None and len(self.ring):
+                self.started = time.monotonic()
+
+        if self.eof and not len(self.ring):
+            return b""
+
+        data = self.ring.pop()
+        if data is None:
+            # アンダーラン時は目標の深さまで貯め直す
+            self.filling = True
+            return self.silence
+
+        return data
+
+    def stalled(self, timeout: float) -> bool:
+        # バッファに残っている音声を再生し終えた時点から数える (HLS のようにまとめて届く場合に誤検知しない)
+        buffered = len(self.ring) * Encoder.FRAME_LENGTH / 1000
+        return time.monotonic() - self.ring.last_received - buffered > timeout
+
+    def is_opus(self) -> bool:
+        return self.opus
+
+    def cleanup(self):
+        self.close()
@@ -3,7 +3,7 @@ from __future__ import annotations
 import json
 from dataclasses import dataclass
 from enum import Enum
-from typing import Optional
+from typing import Any, Dict, List, Optional
 
 CONFIG_PATH: str = "config.json"
 
@@ -14,34 +14,115 @@ class Module(Enum):
     RadioGarden = 2
 
 @dataclass
-class Config:
-    debug: bool
-    token: str
+class Station:
+    name: str
+    module: Module
     volume: float
-    prefix: str
+    passthrough: bool
+    primary: bool
+    hls: bool
 
-    voice_channel_id: str
+    voice_channel_ids: List[str]
     text_channel_id: Optional[str]
 
-    module: Module
     radiko_area: Optional[str]
     radiko_station: Optional[str]
     radio_garden_url: Optional[str]
 
+    @property
+    def source(self) -> str:
+        if self.module == Module.Radiko:
+            return f"radiko:{self.radiko_area}:{self.radiko_station}"
+        elif self.module == Module.Agqr:
+            return "agqr"
+        else:
+            return f"rgb:{self.radio_garden_url}"
+
+    @property
+    def stream_key(self) -> str:
+        # 音量とパススルー設定が同じ局だけが 1 つのデコードを共有する
+        return f"{self.source}:{self.volume}:{self.passthrough}"
+
+    @staticmethod
+    def load(d: Dict[str, Any], root: Dict[str, Any], index: int) -> Station:
+        def get(key: str, default: Any = None) -> Any:
+            return d.get(key, root.get(key, default))
+
+        module = Module(get("module", 1))
+        voice_channel_id = get("voice_channel_id")
+
+        return Station(
+            name=d.get("name") or f"{module.name}-{index}",
+            module=module,
+            volume=get("volume", 1.0),
+            passthrough=get("passthrough", False),
+            primary=d.get("primary", index == 0),
+            hls=get("hls", False),
+            voice_channel_ids=voice_channel_id if isinstance(voice_channel_id, list) else [voice_channel_id],
+            text_channel_id=get("text_channel_id"),
+            radiko_area=get("radiko_area") or "JP13",
+            radiko_station=get("radiko_station") or "QRR",
+            radio_garden_url=get("radio_garden_url")
+        )
+
+@dataclass
+class Config:
+    debug: bool
+    token: str
+    prefix: str
+
+    stations: List[Station]
+
+    buffer_size: int
+    buffer_depth: int
+    stall_timeout: float
+    standby: bool
+    workers: bool
+    record: bool
+    record_hours: float
+    normalize: bool
+    metrics_port: Optional[int]
+    radio_garden_directory: str
+    radio_garden_refresh: float
+
+    http_limit: int
+    http_limit_per_host: int
+
     @staticmethod
     def load() -> Config:
         with open(CONFIG_PATH, "r") as f:
             d = json.load(f)
 
+        stations = [Station.load(x, d, i) for i, x in enumerate(d.get("stations") or [{}])]
+
+        # 1 つのボイスチャンネルには 1 局しか接続できない
+        channel_ids = [x for station in stations for x in station.voice_channel_ids if x]
+        duplicates = {x for x in channel_ids if channel_ids.count(x) > 1}
+        if duplicates:
+            raise ValueError(f"voice channels {sorted(duplicates)} are used by more than one station.")
+
+        # 局名は状態の保存先と Cog の名前に使うので重複させない
+        names = [x.name for x in stations]
+        duplicates = {x for x in names if names.count(x) > 1}
+        if duplicates:
+            raise ValueError(f"station names {sorted(duplicates)} are used by more than one station.")
+
         return Config(
             debug=d.get("debug", False),
             token=d["token"],
-            volume=d.get("volume", 1.0),
             prefix=d.get("prefix") or "r!",
-            voice_channel_id=d["voice_channel_id"],
-            text_channel_id=d.get("text_channel_id"),
-            module=Module(d.get("module", 1)),
-            radiko_area=d.get("radiko_area"),
-            radiko_station=d.get("radiko_station"),
-            radio_garden_url=d.get("radio_garden_url")
+            stations=stations,
+            buffer_size=d.get("buffer_size", 250),
+            buffer_depth=d.get("buffer_depth", 25),
+            stall_timeout=d.get("stall_timeout", 10.0),
+            standby=d.get("standby", False),
+            workers=d.get("workers", False),
+            record=d.get("record", False),
+            record_hours=d.get("record_hours", 24),
+            normalize=d.get("normalize", False),
+            metrics_port=d.get("metrics_port"),
+            radio_garden_directory=d.get("radio_garden_directory") or "radio_garden.json",
+            radio_garden_refresh=d.get("radio_garden_refresh", 7 * 24),
+            http_limit=d.get("http_limit", 100),
+            http_limit_per_host=d.get("http_limit_per_host", 8)
         )
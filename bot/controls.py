@@ -0,0 +1,162 @@
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+from discord import Embed
+from discord.ext import commands
+
+from bot.app import App
+from bot.config import Module
+from bot.garden import GardenStation, RadioGardenDirectory
+from bot.player import RadioPlayer
+
+
+class Controls(commands.Cog):
+    def __init__(self):
+        # チャンネルごとの直前の検索結果 (番号で切り替えられるようにする)
+        self.results: Dict[int, List[GardenStation]] = {}
+
+    async def cog_command_error(self, ctx: commands.Context, error: commands.CommandError):
+        if isinstance(error, commands.CheckFailure):
+            await ctx.send("You need the Manage Server permission to control stations.")
+        elif isinstance(error, commands.UserInputError):
+            await self.usage(ctx)
+        else:
+            App.logger.error(f"Command {ctx.command} failed.", exc_info=error)
+
+    @staticmethod
+    async def usage(ctx: commands.Context):
+        await ctx.send(f"Usage: {ctx.prefix}{ctx.command.qualified_name} {ctx.command.signature}")
+
+    @staticmethod
+    async def targets(ctx: commands.Context, exclusive: bool = False) -> List[RadioPlayer]:
+        # 他のサーバーの再生には触れないよう, コマンドを受けたサーバーの局だけを対象にする
+        players = [x for x in App.players.values() if ctx.guild and ctx.guild.id in x.guild_ids()]
+
+        # テキストチャンネルに紐付いた局があればその局だけを対象にする
+        players = [x for x in players if x.station.text_channel_id == ctx.channel.id] or players
+        if not players:
+            await ctx.send("No station is bound to this server.")
+            return players
+
+        # 局そのものを変えるコマンドは, 他のサーバーでも再生している局には使わない
+        if exclusive:
+            shared = [x for x in players if x.guild_ids() - {ctx.guild.id}]
+            players = [x for x in players if x not in shared]
+            if shared:
+                await ctx.send(f"{', '.join(x.station.name for x in shared)} is shared with other servers and cannot be changed here.")
+
+        return players
+
+    @commands.command()
+    @commands.guild_only()
+    @commands.has_guild_permissions(manage_guild=True)
+    async def volume(self, ctx: commands.Context, volume: float):
+        players = await self.targets(ctx, exclusive=True)
+        if not players:
+            return
+
+        for player in players:
+            await player.set_volume(volume)
+
+        await ctx.send(f"Volume: {volume}")
+
+    @commands.command()
+    @commands.guild_only()
+    @commands.has_guild_permissions(manage_guild=True)
+    async def rewind(self, ctx: commands.Context, minutes: float):
+        await self.replay(ctx, time.time() - minutes * 60)
+
+    @commands.command()
+    @commands.guild_only()
+    @commands.has_guild_permissions(manage_guild=True)
+    async def seek(self, ctx: commands.Context, at: str):
+        # HH:MM で指定された直近の時刻から再生する
+        try:
+            time_of_day = datetime.strptime(at, "%H:%M").time()
+        except ValueError:
+            await self.usage(ctx)
+            return
+
+        now = datetime.now()
+        target = datetime.combine(now.date(), time_of_day)
+        if target > now:
+            target -= timedelta(days=1)
+
+        await self.replay(ctx, target.timestamp())
+
+    @commands.command()
+    @commands.guild_only()
+    @commands.has_guild_permissions(manage_guild=True)
+    async def live(self, ctx: commands.Context):
+        players = await self.targets(ctx)
+        if not players:
+            return
+
+        for player in players:
+            if player.hub:
+                player.live(ctx.guild.id)
+
+        await ctx.send("Live")
+
+    @commands.command()
+    async def search(self, ctx: commands.Context, *, query: str):
+        started = time.perf_counter()
+        results = RadioGardenDirectory.search(query)
+        elapsed = time.perf_counter() - started
+
+        if not results:
+            await ctx.send(f"No stations found in {len(RadioGardenDirectory.index)} stations.")
+            return
+        self.results[ctx.channel.id] = results
+
+        embed = Embed(
+            title=f"Radio Garden: {query}",
+            description="\n".join(f"{i}. [{x.name}]({x.page_url}) ({x.place}, {x.country})" for i, x in enumerate(results, 1)),
+            color=0x42f58d
+        )
+        embed.set_footer(
+            text=f"Searched {len(RadioGardenDirectory.index)} stations in {elapsed * 1000:.1f}ms. Use {ctx.prefix}switch <number> to switch."
+        )
+
+        await ctx.send(embed=embed)
+
+    @commands.command()
+    @commands.guild_only()
+    @commands.has_guild_permissions(manage_guild=True)
+    async def switch(self, ctx: commands.Context, *, query: str):
+        # 番号なら直前の検索結果から, それ以外は最も一致する局に切り替える
+        results = self.results.get(ctx.channel.id, [])
+        if query.isdigit() and 0 < int(query) <= len(results):
+            entry = results[int(query) - 1]
+        else:
+            found = RadioGardenDirectory.search(query, 1)
+            if not found:
+                await ctx.send("No stations found.")
+                return
+            entry = found[0]
+
+        players = await self.targets(ctx, exclusive=True)
+        if not players:
+            return
+
+        players = [x for x in players if x.station.module == Module.RadioGarden]
+        if not players:
+            await ctx.send("No Radio Garden station to switch.")
+            return
+
+        for player in players:
+            await player.tune(entry)
+
+        await ctx.send(f"Switched to {entry.name} ({entry.place}, {entry.country})")
+
+    async def replay(self, ctx: commands.Context, timestamp: float):
+        players = await self.targets(ctx)
+        if not players:
+            return
+
+        if not any([x.replay(timestamp, ctx.guild.id) for x in players]):
+            await ctx.send("No recording available.")
+            return
+
+        await ctx.send(f"Replaying from {datetime.fromtimestamp(timestamp):%H:%M:%S}")
@@ -0,0 +1,266 @@
+from __future__ import annotations
+
+import asyncio
+import bisect
+import heapq
+import json
+import os
+import re
+import time
+import unicodedata
+from array import array
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List, Optional, Set
+
+from bot.app import App
+from bot.session import Session
+
+API_URL: str = "https://radio.garden/api/ara/content"
+
+
+@dataclass
+class GardenStation:
+    id: str
+    name: str
+    country: str
+    place: str
+    page: str
+
+    @property
+    def url(self) -> str:
+        return f"{API_URL}/listen/{self.id}/channel.mp3"
+
+    @property
+    def page_url(self) -> str:
+        return f"https://radio.garden{self.page}"
+
+
+def normalize(text: str) -> str:
+    # 全角と半角, 大文字と小文字, 記号, アクセント記号の違いを無視して比べる
+    text = "".join(x for x in unicodedata.normalize("NFKD", text) if not unicodedata.combining(x))
+    return " ".join(re.findall(r"\w+", unicodedata.normalize("NFKC", text).casefold()))
+
+def trigrams(text: str) -> Set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class GardenIndex:
+    def __init__(self, stations: List[GardenStation]):
+        self.stations = stations
+        self.names = [normalize(x.name) for x in stations]
+        self.texts = [normalize(f"{x.name} {x.place} {x.country}") for x in stations]
+        self.urls = {x.url: i for i, x in enumerate(stations)}
+
+        tokens: Dict[str, List[int]] = {}
+        grams: Dict[str, List[int]] = {}
+        for i, text in enumerate(self.texts):
+            for token in set(text.split()):
+                tokens.setdefault(token, []).append(i)
+            for gram in trigrams(text):
+                grams.setdefault(gram, []).append(i)
+
+        # 局の番号は array に詰め, 数万局でも索引を小さく保つ
+        self.tokens = sorted(tokens)
+        self.token_postings = [array("I", tokens[x]) for x in self.tokens]
+        self.trigrams = {k: array("I", v) for k, v in grams.items()}
+
+    def __len__(self) -> int:
+        return len(self.stations)
+
+    def prefix(self, word: str) -> Set[int]:
+        # 3 文字未満の語は, 単語の前方一致で探す
+        found: Set[int] = set()
+        i = bisect.bisect_left(self.tokens, word)
+        while i < len(self.tokens) and self.tokens[i].startswith(word):
+            found.update(self.token_postings[i])
+            i += 1
+
+        return found
+
+    def substring(self, word: str) -> Set[int]:
+        postings = sorted((self.trigrams.get(x, array("I")) for x in trigrams(word)), key=len)
+        found = set(postings[0])
+        for posting in postings[1:]:
+            if not found:
+                break
+            found.intersection_update(posting)
+
+        # トライグラムがすべて含まれていても, 並びが違う局を除く
+        return {i for i in found if word in self.texts[i]}
+
+    def selectivity(self, word: str) -> int:
+        # トライグラムで引ける語は, 最も短い転置リストの長さで候補の数を見積もる
+        if len(word) < 3:
+            return len(self.stations) + 1
+
+        return min(len(self.trigrams.get(x, ())) for x in trigrams(word))
+
+    def search(self, query: str, limit: int = 10) -> List[GardenStation]:
+        words = normalize(query).split()
+        if not words:
+            return []
+
+        query = " ".join(words)
+
+        # 最も絞り込める語だけを索引で引き, 残りの語は候補に対して直接確かめる
+        words.sort(key=self.selectivity)
+        candidates = self.substring(words[0]) if len(words[0]) >= 3 else self.prefix(words[0])
+        for word in words[1:]:
+            if len(word) >= 3:
+                candidates = {i for i in candidates if word in self.texts[i]}
+            else:
+                candidates = {i for i in candidates if any(x.startswith(word) for x in self.texts[i].split())}
+
+        if not candidates:
+            return []
+
+        # 局名の完全一致, 前方一致, 部分一致, 短い名前の順に並べる
+        def rank(i: int):
+            name = self.names[i]
+            return name != query, not name.startswith(query), query not in name, len(name), i
+
+        return [self.stations[i] for i in heapq.nsmallest(limit, candidates, key=rank)]
+
+    def find(self, url: str) -> Optional[GardenStation]:
+        i = self.urls.get(url)
+        return self.stations[i] if i is not None else None
+
+
+class RadioGardenDirectory:
+    # Radio Garden の全局の一覧をローカルに保存し, 定期的に取得し直す
+    index: GardenIndex = GardenIndex([])
+    updated: float = 0
+    loaded: Optional[asyncio.Event] = None
+    task: Optional[asyncio.Task] = None
+    concurrency: int = 4
+    retry_delay: float = 10 * 60
+
+    @classmethod
+    def start(cls):
+        if not cls.task:
+            cls.loaded = asyncio.Event()
+            cls.task = asyncio.create_task(cls.run())
+
+    @classmethod
+    async def wait(cls):
+        if cls.loaded:
+            await cls.loaded.wait()
+
+    @classmethod
+    def search(cls, query: str, limit: int = 10) -> List[GardenStation]:
+        return cls.index.search(query, limit)
+
+    @classmethod
+    def find(cls, url: str) -> Optional[GardenStation]:
+        return cls.index.find(url)
+
+    @classmethod
+    async def run(cls):
+        path = App.config.radio_garden_directory
+        try:
+            await cls.load(path)
+        finally:
+            cls.loaded.set()
+
+        # 0 の場合は保存済みの一覧 (フィクスチャなど) だけを使う
+        refresh = App.config.radio_garden_refresh * 60 * 60
+        if not refresh:
+            return
+
+        while True:
+            await asyncio.sleep(max(cls.updated + refresh - time.time(), 0))
+
+            try:
+                stations = await cls.crawl()
+            except Exception as e:
+                App.logger.warning(f"Failed to refresh Radio Garden directory: {e}")
+                await asyncio.sleep(cls.retry_delay)
+                continue
+
+            cls.index = await asyncio.get_running_loop().run_in_executor(None, GardenIndex, stations)
+            cls.updated = time.time()
+            cls.save(path)
+            App.logger.info(f"Refreshed Radio Garden directory with {len(stations)} stations.")
+
+    @classmethod
+    async def load(cls, path: str):
+        def read() -> Dict[str, Any]:
+            with open(path, "r") as f:
+                return json.load(f)
+
+        try:
+            d = await asyncio.get_running_loop().run_in_executor(None, read)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            App.logger.warning(f"Failed to load {path}: {e}")
+            return
+
+        stations = [GardenStation(**x) for x in d["stations"]]
+        cls.index = await asyncio.get_running_loop().run_in_executor(None, GardenIndex, stations)
+        cls.updated = d.get("updated", 0)
+        App.logger.info(f"Loaded {len(stations)} Radio Garden stations from {path}.")
+
+    @classmethod
+    def save(cls, path: str):
+        try:
+            with open(f"{path}.tmp", "w") as f:
+                json.dump({"updated": cls.updated, "stations": [asdict(x) for x in cls.index.stations]}, f, ensure_ascii=False)
+            os.replace(f"{path}.tmp", path)
+        except OSError as e:
+            App.logger.warning(f"Failed to save {path}: {e}")
+
+    @classmethod
+    async def crawl(cls) -> List[GardenStation]:
+        async with Session.get().get(f"{API_URL}/places") as response:
+            response.raise_for_status()
+            places = (await response.json())["data"]["list"]
+        # 空の一覧で保存済みの索引を上書きしないよう, 失敗として扱う
+        if not places:
+            raise RuntimeError("no places found")
+
+        # 地点ごとの局の一覧は, 共有のコネクションプールを占有しないよう少しずつ取得する
+        semaphore = asyncio.Semaphore(cls.concurrency)
+        async def fetch(place: Dict[str, Any]) -> List[GardenStation]:
+            async with semaphore:
+                async with Session.get().get(f"{API_URL}/page/{place['id']}/channels") as response:
+                    response.raise_for_status()
+                    return parse_channels(place, await response.json())
+
+        results = await asyncio.gather(*(fetch(x) for x in places), return_exceptions=True)
+        failed = sum(isinstance(x, Exception) for x in results)
+        if failed > len(places) // 2:
+            raise RuntimeError(f"{failed} of {len(places)} places failed")
+
+        stations: Dict[str, GardenStation] = {}
+        for result in results:
+            if not isinstance(result, Exception):
+                for station in result:
+                    stations.setdefault(station.id, station)
+        if not stations:
+            raise RuntimeError(f"no stations found in {len(places)} places")
+
+        return list(stations.values())
+
+def parse_channels(place: Dict[str, Any], d: Dict[str, Any]) -> List[GardenStation]:
+    stations = []
+    for section in d["data"].get("content", []):
+        for item in section.get("items", []):
+            page = item.get("page") or item
+            path = page.get("url") or page.get("href")
+            if not path or not path.startswith("/listen/"):
+                continue
+
+            # 近くの地点の局も並ぶので, その地点の局だけを拾う
+            if (page.get("place") or {}).get("id", place["id"]) != place["id"]:
+                continue
+
+            stations.append(GardenStation(
+                id=path.rstrip("/").rsplit("/", 1)[-1],
+                name=page.get("title", ""),
+                country=place.get("country", ""),
+                place=place.get("title", ""),
+                page=path
+            ))
+
+    return stations
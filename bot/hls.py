@@ -0,0 +1,191 @@
+from __future__ import annotations
+
+import asyncio
+import re
+import urllib.parse
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+import aiohttp
+
+from bot.app import App
+from bot.session import Session
+
+
+@dataclass
+class HlsPlaylist:
+    sequence: int = 0
+    target_duration: float = 5
+    segments: List[str] = field(default_factory=list)
+    # 各セグメントの初期化セクション (#EXT-X-MAP)
+    maps: List[Optional[str]] = field(default_factory=list)
+    variants: List[str] = field(default_factory=list)
+    ended: bool = False
+
+    @staticmethod
+    def parse(text: str, base_url: str) -> HlsPlaylist:
+        playlist = HlsPlaylist()
+        variant = False
+        init: Optional[str] = None
+
+        for line in text.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+
+            if line.startswith("#"):
+                tag, _, value = line.partition(":")
+                if tag == "#EXT-X-MEDIA-SEQUENCE":
+                    playlist.sequence = int(value)
+                elif tag == "#EXT-X-TARGETDURATION":
+                    playlist.target_duration = float(value)
+                elif tag == "#EXT-X-STREAM-INF":
+                    variant = True
+                elif tag == "#EXT-X-ENDLIST":
+                    playlist.ended = True
+                # 復号や部分取得はしないので, そうしたストリームはデコーダーに渡さずに取り込みを失敗させる
+                elif tag == "#EXT-X-KEY" and attributes(value).get("METHOD", "NONE") != "NONE":
+                    raise ValueError(f"encrypted HLS ({attributes(value)['METHOD']}) is not supported")
+                elif tag == "#EXT-X-BYTERANGE" or tag == "#EXT-X-MAP" and "BYTERANGE" in attributes(value):
+                    raise ValueError("byte-range HLS is not supported")
+                elif tag == "#EXT-X-MAP":
+                    init = urllib.parse.urljoin(base_url, attributes(value)["URI"])
+                continue
+
+            url = urllib.parse.urljoin(base_url, line)
+            if variant:
+                playlist.variants.append(url)
+                variant = False
+            else:
+                playlist.segments.append(url)
+                playlist.maps.append(init)
+
+        return playlist
+
+def attributes(value: str) -> Dict[str, str]:
+    return {k: v.strip('"') for k, v in re.findall(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)', value)}
+
+
+class HlsIngest:
+    # 同時に取得するセグメント数
+    prefetch: int = 3
+    # 再生開始時にライブの端から遡るセグメント数
+    live_edge: int = 3
+    retries: int = 2
+    segment_timeout: float = 10
+
+    def __init__(self, url: str, headers: Callable[[], Dict[str, str]] = dict):
+        self.url = url
+        # 認証トークンは途中で更新されうるので, リクエストのたびにヘッダーを作る
+        self.headers = headers
+        self.semaphore = asyncio.Semaphore(self.prefetch)
+        self.playlist: Optional[HlsPlaylist] = None
+
+    async def open(self):
+        # 最初のプレイリストを先に取得し, バッファの大きさを決められるようにする
+        playlist = await self.fetch_playlist(self.url)
+        while playlist.variants:
+            self.url = playlist.variants[0]
+            playlist = await self.fetch_playlist(self.url)
+        self.playlist = playlist
+
+    @property
+    def backlog(self) -> float:
+        # 再生開始時にまとめて書き込む秒数
+        target_duration = self.playlist.target_duration if self.playlist else HlsPlaylist.target_duration
+        return target_duration * self.live_edge
+
+    async def run(self, writer: asyncio.StreamWriter):
+        queue: asyncio.Queue = asyncio.Queue()
+        poller = asyncio.create_task(self.poll(queue))
+
+        try:
+            # 取得は並列に進め, デコーダーへはシーケンス順に書き込む
+            while True:
+                task: Optional[asyncio.Task] = await queue.get()
+                if not task:
+                    break
+
+                try:
+                    data = await task
+                except Exception as e:
+                    App.logger.warning(f"Failed to fetch HLS segment: {e!r}")
+                    continue
+
+                writer.write(data)
+                await writer.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            poller.cancel()
+            while not queue.empty():
+                task = queue.get_nowait()
+                if task:
+                    task.cancel()
+            writer.close()
+
+    async def poll(self, queue: asyncio.Queue):
+        next_sequence: Optional[int] = None
+        init: Optional[str] = None
+
+        try:
+            if not self.playlist:
+                await self.open()
+            playlist, self.playlist = self.playlist, None
+
+            while True:
+                if next_sequence is None:
+                    next_sequence = playlist.sequence + max(len(playlist.segments) - self.live_edge, 0)
+
+                # 遅れて届いたセグメントを待つ間もバッファが尽きないよう, 1 セグメント分を残して打ち切る
+                deadline = asyncio.get_running_loop().time() + playlist.target_duration * max(self.live_edge - 1, 1)
+                for i, (segment, segment_init) in enumerate(zip(playlist.segments, playlist.maps)):
+                    sequence = playlist.sequence + i
+                    if sequence >= next_sequence:
+                        # 初期化セクションは変わったときだけ, セグメントの前に書き込む
+                        if segment_init and segment_init != init:
+                            queue.put_nowait(asyncio.create_task(self.fetch_segment(segment_init, deadline)))
+                            init = segment_init
+                        queue.put_nowait(asyncio.create_task(self.fetch_segment(segment, deadline)))
+                        next_sequence = sequence + 1
+
+                if playlist.ended:
+                    break
+
+                await asyncio.sleep(playlist.target_duration / 2)
+                playlist = await self.fetch_playlist(self.url)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            App.logger.warning(f"Failed to poll HLS playlist: {e}")
+
+        queue.put_nowait(None)
+
+    async def fetch_playlist(self, url: str) -> HlsPlaylist:
+        for attempt in range(self.retries + 1):
+            try:
+                async with Session.get().get(url, headers=self.headers()) as response:
+                    response.raise_for_status()
+                    return HlsPlaylist.parse(await response.text(), str(response.url))
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == self.retries:
+                    raise
+
+    async def fetch_segment(self, url: str, deadline: float) -> bytes:
+        loop = asyncio.get_running_loop()
+
+        async with self.semaphore:
+            # 遅いセグメントは締め切りまでの時間を試行ごとに分けて打ち切り, 取り直す
+            # それでも届かなければ諦めて読み飛ばす
+            for attempt in range(self.retries + 1):
+                timeout = min(self.segment_timeout, (deadline - loop.time()) / (self.retries + 1 - attempt))
+                if timeout <= 0:
+                    raise asyncio.TimeoutError(f"{url} missed its deadline")
+
+                try:
+                    async with Session.get().get(url, headers=self.headers(), timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                        response.raise_for_status()
+                        return await response.read()
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    if attempt == self.retries:
+                        raise
@@ -0,0 +1,152 @@
+from __future__ import annotations
+
+import threading
+from collections import deque
+from typing import TYPE_CHECKING, Callable, Deque, Dict, List, Optional, Tuple
+
+from discord import AudioSource, VoiceClient
+from discord.opus import Encoder
+
+from bot.app import App
+from bot.audio import OPUS_SILENCE, apply_volume
+
+if TYPE_CHECKING:
+    from bot.recorder import Recorder
+    from bot.supervisor import Supervisor
+
+
+class BroadcastHub:
+    hubs: Dict[str, BroadcastHub] = {}
+
+    def __init__(self, key: str, backlog: int = 50):
+        self.key = key
+        self.frames: Deque[Tuple[int, bytes]] = deque(maxlen=backlog)
+        self.sequence = 0
+        self.sent = 0
+        self.source: Optional[AudioSource] = None
+        # パイプラインを起動したときの音量と, その後に変更された音量
+        self.baked_volume = 1.0
+        self.volume: Optional[float] = None
+        self.after: Optional[Callable[[Optional[Exception]], None]] = None
+        self.encoder: Optional[Encoder] = None
+        self.subscribers: List[HubSource] = []
+        self.supervisor: Optional[Supervisor] = None
+        self.recorder: Optional[Recorder] = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get(cls, key: str) -> BroadcastHub:
+        if key not in cls.hubs:
+            cls.hubs[key] = BroadcastHub(key)
+
+        return cls.hubs[key]
+
+    def play(self, source: AudioSource, after: Optional[Callable[[Optional[Exception]], None]] = None, volume: float = 1.0):
+        with self.lock:
+            self._stop()
+            self.source = source
+            self.after = after
+            self.baked_volume = volume
+            # 音量を変える前に起動していたパイプラインにも, 今の音量を掛ける
+            if self.volume is not None:
+                self.source = apply_volume(source, self.volume, volume)
+
+    def set_volume(self, volume: float):
+        # パイプラインを起動し直さずに, 再生中の音源の音量だけを変える
+        with self.lock:
+            self.volume = volume
+            if self.source:
+                self.source = apply_volume(self.source, volume, self.baked_volume)
+
+    def rekey(self, key: str):
+        BroadcastHub.hubs.pop(self.key, None)
+        self.key = key
+        BroadcastHub.hubs[key] = self
+
+    def stop(self):
+        with self.lock:
+            self._stop()
+
+    def _stop(self, error: Optional[Exception] = None):
+        source, after = self.source, self.after
+        self.source, self.after = None, None
+
+        if source:
+            source.cleanup()
+        if after:
+            after(error)
+
+    def subscribe(self, voice: VoiceClient) -> HubSource:
+        source = HubSource(self)
+        self.subscribers.append(source)
+        voice.play(source)
+
+        return source
+
+    def unsubscribe(self, source: HubSource):
+        if source in self.subscribers:
+            self.subscribers.remove(source)
+
+    def frame(self, sequence: int) -> Tuple[int, bytes]:
+        with self.lock:
+            if self.frames:
+                oldest, latest = self.frames[0][0], self.frames[-1][0]
+                # 他の購読者が既に読み出したフレームはそのまま共有する
+                if oldest <= sequence <= latest:
+                    return self.frames[sequence - oldest]
+                # 遅れすぎた購読者はライブ位置に追いつかせる
+                if sequence < oldest:
+                    return self.frames[-1]
+
+            self.sequence += 1
+            self.frames.append((self.sequence, self._read()))
+
+            # エンコード済みのフレームをそのまま録音に回し, 上流への接続を増やさない
+            if self.recorder:
+                try:
+                    self.recorder.write(self.frames[-1][1])
+                except Exception as e:
+                    # 録音の不具合で全サーバーの再生を止めないよう, このハブの録音だけをやめる
+                    App.logger.error(f"{self.key}: recording disabled: {e}")
+                    self.recorder = None
+
+            return self.frames[-1]
+
+    def _read(self) -> bytes:
+        if not self.source:
+            return OPUS_SILENCE
+
+        try:
+            data = self.source.read()
+        except Exception as e:
+            self._stop(e)
+            return OPUS_SILENCE
+
+        if not data:
+            self._stop()
+            return OPUS_SILENCE
+
+        if self.source.is_opus():
+            return data
+
+        if not self.encoder:
+            self.encoder = Encoder()
+
+        return self.encoder.encode(data, Encoder.SAMPLES_PER_FRAME)
+
+
+class HubSource(AudioSource):
+    def __init__(self, hub: BroadcastHub):
+        self.hub = hub
+        self.sequence = hub.sequence
+
+    def read(self) -> bytes:
+        self.sequence, data = self.hub.frame(self.sequence + 1)
+        self.hub.sent += 1
+        return data
+
+    def is_opus(self) -> bool:
+        return True
+
+    def cleanup(self):
+        self.hub.unsubscribe(self)
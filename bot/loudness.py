@@ -0,0 +1,167 @@
+from __future__ import annotations
+
+import math
+from collections import deque
+from typing import Deque, List, Tuple
+
+import numpy as np
+from discord import AudioSource, PCMVolumeTransformer
+from discord.opus import Encoder
+
+from bot.audio import PCM_SILENCE
+
+# ITU-R BS.1770 の K 特性 (48kHz) の係数
+SHELF = ([1.53512485958697, -2.69169618940638, 1.19839281085285], [1.0, -1.69065929318241, 0.73248077421585])
+HIGH_PASS = ([1.0, -2.0, 1.0], [1.0, -1.99004745483398, 0.99007225036621])
+
+
+def k_weighting(size: int, step: int = 1) -> np.ndarray:
+    # 時間領域で IIR を回す代わりに, rfft の各ビンでの振幅応答の 2 乗を重みとして使う
+    # step 個おきに間引いた信号のビンは, 48kHz での周波数に換算して重みを求める
+    w = 2 * np.pi * np.fft.rfftfreq(size) / step
+    z = np.exp(-1j * w)
+
+    weights = np.ones(len(w))
+    for b, a in (SHELF, HIGH_PASS):
+        h = (b[0] + b[1] * z + b[2] * z ** 2) / (a[0] + a[1] * z + a[2] * z ** 2)
+        weights *= np.abs(h) ** 2
+
+    # パーセバルの定理で平均二乗に戻すため, 片側スペクトルの重複分と正規化をまとめておく
+    weights[1:-1] *= 2
+    return (weights / size ** 2).astype(np.float32)
+
+
+class LoudnessTransformer(PCMVolumeTransformer):
+    # 正規化の目標 (LUFS)
+    target: float = -18
+    # 200ms 分のフレームをまとめて読み, NumPy の 1 回の演算で処理する (フレームごとの呼び出しより安い)
+    block_frames: int = 10
+    # ラウドネスはすべてのサンプルを 4 つおきに間引いた 12kHz の信号で 100ms ごとに測り, 直近 3.2 秒分で平均する
+    # (K 特性のシェルフは 2kHz 付近で立ち上がるので, 折り返しによる誤差は高域の多い音でも 1dB 程度に収まる)
+    # FFT は 1 回ごとの固定の費用が大きいので, 4 ブロック (800ms) 分をまとめて変換する
+    analysis_step: int = 4
+    analysis_size: int = 1200
+    analysis_blocks: int = 4
+    window: int = 32
+    gate: float = -70
+    max_gain: float = 4
+    # 測定ごとに目標のゲインへ近づける割合
+    smoothing: float = 0.4
+    # リミッターの上限 (-1 dBFS) と, 1 ブロックあたりの戻り幅
+    ceiling: float = 0.89
+    release: float = 0.2
+    fade_blocks: int = 3
+
+    def __init__(self, original: AudioSource, volume: float = 1.0):
+        super().__init__(original, volume)
+
+        samples = Encoder.SAMPLES_PER_FRAME
+        # 複素数のスペクトルを実部と虚部の並びとして 2 乗し, そのまま重みをかけられるようにする
+        self.weights = np.repeat(k_weighting(self.analysis_size, self.analysis_step).astype(np.float64) / 32768 ** 2, 2)
+        chunks = self.block_frames * samples // self.analysis_step // self.analysis_size
+        self.history = np.empty((self.analysis_blocks, chunks, Encoder.CHANNELS, self.analysis_size))
+        self.collected = 0
+        # チャンネルを交互に並べたままの 1 次元の配列で扱い, ブロードキャストを避ける
+        size = self.block_frames * samples * Encoder.CHANNELS
+        self.ramp = np.repeat(np.linspace(0, 1, self.block_frames * samples, dtype=np.float32), Encoder.CHANNELS)
+        # ブロックごとの配列の確保を避けるため, 作業用の配列を使い回す
+        self.gains = np.empty(size, dtype=np.float32)
+        self.scaled = np.empty(size, dtype=np.float32)
+        self.output = np.empty(size, dtype=np.int16)
+        self.powers: Deque[float] = deque(maxlen=self.window)
+        self.pending: Deque[bytes] = deque()
+        self.eof = False
+
+        self.gain = 1.0
+        self.limit = 1.0
+        self.applied = 0.0
+        self.blocks = 0
+
+    def state(self) -> Tuple[float, float, List[float]]:
+        return self.gain, self.limit, list(self.powers)
+
+    def resume(self, state: Tuple[float, float, List[float]]):
+        # 再起動後も前のパイプラインで測ったラウドネスを引き継ぎ, 音量が跳ねないようにする (フェードインはやり直す)
+        self.gain, self.limit, powers = state
+        self.powers.extend(powers)
+
+    def analyze(self, samples: np.ndarray):
+        # (区間, チャンネル, サンプル) に並べ替えて溜め, 区間ごとの各チャンネルの平均二乗の和を求める
+        chunks = samples[::self.analysis_step].reshape(-1, self.analysis_size, Encoder.CHANNELS).transpose(0, 2, 1)
+        np.copyto(self.history[self.collected], chunks)
+        self.collected += 1
+        if self.collected < self.analysis_blocks:
+            return
+        self.collected = 0
+
+        spectrum = np.fft.rfft(self.history.reshape(-1, Encoder.CHANNELS, self.analysis_size)).view(np.float64)
+        powers = ((spectrum * spectrum) @ self.weights).sum(axis=1)
+
+        for power in powers.tolist():
+            if power > 0 and -0.691 + 10 * math.log10(power) >= self.gate:
+                self.powers.append(power)
+        if not self.powers:
+            return
+
+        loudness = -0.691 + 10 * math.log10(sum(self.powers) / len(self.powers))
+        target = min(10 ** ((self.target - loudness) / 20), self.max_gain)
+        self.gain += (target - self.gain) * self.smoothing
+
+    def process(self, block: bytes, analyze: bool = True) -> bytes:
+        samples = np.frombuffer(block, dtype=np.int16).reshape(-1, Encoder.CHANNELS)
+        if analyze:
+            self.analyze(samples)
+
+        # 再起動直後は無音から立ち上げ, 音の途切れを目立たなくする
+        self.blocks += 1
+        fade = min(self.blocks / self.fade_blocks, 1.0)
+        gain = self.gain * fade * min(self.volume, 2.0)
+
+        # 上限を超えそうなブロックは即座に下げ, ゆっくり戻す
+        peak = max(int(samples.max()), -int(samples.min()))
+        level = peak / 32768 * gain
+        self.limit = min(self.limit + self.release, self.ceiling / level if level > self.ceiling else 1.0, 1.0)
+        gain *= self.limit
+
+        applied, self.applied = self.applied, gain
+
+        # ゲインが変わるブロックだけ, 切り替わりの雑音が出ないよう直線的に変化させる
+        flat = samples.reshape(-1)
+        if abs(gain - applied) < 1e-4:
+            np.multiply(flat, np.float32(gain), out=self.scaled)
+        else:
+            np.multiply(self.ramp, np.float32(gain - applied), out=self.gains)
+            self.gains += np.float32(applied)
+            np.multiply(flat, self.gains, out=self.scaled)
+
+        # 前のブロックのゲインから下げる途中だけは上限を超えうる
+        if peak * max(gain, applied) > 32767:
+            np.clip(self.scaled, -32768, 32767, out=self.scaled)
+
+        np.copyto(self.output, self.scaled, casting="unsafe")
+        return self.output.tobytes()
+
+    def fill(self):
+        frames = []
+        for _ in range(self.block_frames):
+            data = self.original.read()
+            if len(data) != Encoder.FRAME_SIZE:
+                self.eof = True
+                break
+            frames.append(data)
+
+        # バッファが貯まるまでの無音はそのまま返し, フェードインと測定を進めない
+        if frames.count(PCM_SILENCE) == len(frames):
+            self.pending.extend(frames)
+            return
+
+        # 終わりの半端なフレームも無音で埋めて同じゲインをかける (測定には含めない)
+        count = len(frames)
+        data = self.process(b"".join(frames) + PCM_SILENCE * (self.block_frames - count), analyze=count == self.block_frames)
+        self.pending.extend(data[i:i + Encoder.FRAME_SIZE] for i in range(0, count * Encoder.FRAME_SIZE, Encoder.FRAME_SIZE))
+
+    def read(self) -> bytes:
+        if not self.pending and not self.eof:
+            self.fill()
+
+        return self.pending.popleft() if self.pending else b""
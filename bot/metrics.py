@@ -0,0 +1,168 @@
+from __future__ import annotations
+
+import bisect
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from aiohttp import web
+
+from bot.app import App
+
+Labels = Tuple[Tuple[str, str], ...]
+
+# 名前: (種類, 説明)
+METRICS: Dict[str, Tuple[str, str]] = {
+    "radiobot_frames_sent_total": ("counter", "Opus frames sent to voice clients."),
+    "radiobot_underruns_total": ("counter", "Reads from an empty pipeline buffer."),
+    "radiobot_overruns_total": ("counter", "Frames dropped because the pipeline buffer was full."),
+    "radiobot_decoded_bytes_total": ("counter", "Bytes of decoded audio (PCM, or Opus with passthrough) read from the pipeline."),
+    "radiobot_pipeline_restarts_total": ("counter", "Pipeline restarts by reason."),
+    "radiobot_first_audio_seconds": ("gauge", "Time from process start to the first audio frame."),
+    "radiobot_subscribers": ("gauge", "Voice clients subscribed to a stream."),
+    "radiobot_metadata_poll_seconds": ("histogram", "Latency of program metadata requests."),
+    "radiobot_parse_seconds": ("histogram", "Time spent parsing program metadata."),
+    "radiobot_radiko_auth_age_seconds": ("gauge", "Age of the current Radiko auth token."),
+    "radiobot_discord_update_seconds": ("histogram", "Latency from queueing a Discord update to writing it."),
+    "radiobot_discord_update_queue_depth": ("gauge", "Discord updates waiting to be written."),
+}
+
+
+class Histogram:
+    buckets: Tuple[float, ...] = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Metrics:
+    values: Dict[str, Dict[Labels, float]] = {}
+    histograms: Dict[str, Dict[Labels, Histogram]] = {}
+    runner: Optional[web.AppRunner] = None
+
+    @classmethod
+    def inc(cls, name: str, value: float = 1, **labels: str):
+        series = cls.values.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+
+    @classmethod
+    def set(cls, name: str, value: float, **labels: str):
+        cls.values.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+
+    @classmethod
+    def observe(cls, name: str, value: float, **labels: str):
+        series = cls.histograms.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        if key not in series:
+            series[key] = Histogram()
+        series[key].observe(value)
+
+    @classmethod
+    @contextmanager
+    def timer(cls, name: str, **labels: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            cls.observe(name, time.perf_counter() - started, **labels)
+
+    @classmethod
+    def collect(cls):
+        # 再生中に更新され続ける値は, 音声スレッドに手を入れず取得時にまとめて読む
+        from bot.hub import BroadcastHub
+        from bot.radiko import RadikoApiClient
+        from bot.updates import UpdateQueue
+
+        for hub in list(BroadcastHub.hubs.values()):
+            supervisor = hub.supervisor
+            station = supervisor.name if supervisor else hub.key
+
+            cls.set("radiobot_frames_sent_total", hub.sent, station=station)
+            cls.set("radiobot_subscribers", len(hub.subscribers), station=station)
+            if not supervisor:
+                continue
+
+            underruns, overruns, received = supervisor.underruns, supervisor.overruns, supervisor.received
+            if supervisor.pipeline:
+                ring = supervisor.pipeline.buffer.ring
+                underruns, overruns, received = underruns + ring.underruns, overruns + ring.overruns, received + ring.received
+
+            cls.set("radiobot_underruns_total", underruns, station=station)
+            cls.set("radiobot_overruns_total", overruns, station=station)
+            cls.set("radiobot_decoded_bytes_total", received, station=station)
+            if supervisor.first_audio is not None:
+                cls.set("radiobot_first_audio_seconds", supervisor.first_audio, station=station)
+
+        for client in RadikoApiClient.clients.values():
+            if client.auth.token:
+                issued = client.auth.expires - client.auth.lifetime
+                cls.set("radiobot_radiko_auth_age_seconds", (datetime.now() - issued).total_seconds(), area=client.area_id)
+
+        for queue in list(UpdateQueue.queues.values()):
+            cls.set("radiobot_discord_update_queue_depth", queue.depth, queue=queue.name)
+
+    @classmethod
+    def render(cls) -> str:
+        cls.collect()
+
+        lines: List[str] = []
+        for name, (kind, description) in METRICS.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+
+            if kind == "histogram":
+                for labels, histogram in cls.histograms.get(name, {}).items():
+                    count = 0
+                    for bound, n in zip((*histogram.buckets, "+Inf"), histogram.counts):
+                        count += n
+                        lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {count}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{format_labels(labels)} {count}")
+            else:
+                for labels, value in cls.values.get(name, {}).items():
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    @classmethod
+    async def start(cls, port: int):
+        app = web.Application()
+        app.router.add_get("/metrics", cls.handle)
+
+        if App.config.debug:
+            from bot.profiler import Profiler
+            Profiler.start()
+            app.router.add_get("/debug/profile", Profiler.handle)
+
+        # 外部には公開せず, ローカルからの取得だけを受け付ける
+        cls.runner = web.AppRunner(app, access_log=None)
+        await cls.runner.setup()
+        await web.TCPSite(cls.runner, "127.0.0.1", port).start()
+        App.logger.info(f"Serving metrics on http://127.0.0.1:{port}/metrics")
+
+    @classmethod
+    async def stop(cls):
+        if cls.runner:
+            await cls.runner.cleanup()
+            cls.runner = None
+
+    @classmethod
+    async def handle(cls, _: web.Request) -> web.Response:
+        return web.Response(text=cls.render(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels) + "}"
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
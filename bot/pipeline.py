@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import asyncio
+import math
+import os
+from asyncio.subprocess import Process
+from typing import List, Optional
+
+from discord import AudioSource
+from discord.opus import Encoder
+
+from bot.app import App
+from bot.audio import output_source, read_ogg_packets
+from bot.buffer import BufferedSource, RingBuffer
+from bot.hls import HlsIngest
+
+
+class Pipeline:
+    # HLS の取り込みでバッファが一杯のときに, 空くのを待つ間隔
+    backpressure_interval: float = 0.1
+
+    def __init__(self, processes: List[Process], buffer: BufferedSource, volume: float, ingest: Optional[HlsIngest] = None, normalize: bool = False):
+        self.processes = processes
+        self.buffer = buffer
+        self.volume = volume
+        self.upstream: Optional[str] = None
+        # HLS はセグメント単位で実時間より速く届くので, 再生中は溢れさせずに ffmpeg と取り込みを待たせる
+        # (待機中の接続は読まれないので, 古いフレームを捨てて最新の音声を保つ)
+        self.backpressure = ingest is not None
+        self.source: AudioSource = output_source(buffer, volume, normalize)
+        self.task = asyncio.create_task(self.fill())
+        self.ingest_task = asyncio.create_task(ingest.run(processes[0].stdin)) if ingest else None
+
+    @classmethod
+    async def spawn(cls, commands: List[List[str]], passthrough: bool, volume: float, ingest: Optional[HlsIngest] = None) -> Pipeline:
+        # HLS の取り込みはイベントループ上で行うため, ワーカープロセスは使わない
+        if App.config.workers and not ingest:
+            from bot.worker import WorkerPipeline
+            return await WorkerPipeline.spawn(commands, passthrough, volume)
+
+        size = App.config.buffer_size
+        if ingest:
+            # 再生開始時にまとめて届く分とその次のセグメントを収められる大きさにする
+            await ingest.open()
+            size = max(size, math.ceil((ingest.backlog + ingest.playlist.target_duration) * 1000 / Encoder.FRAME_LENGTH))
+
+        processes = await spawn_processes(commands, asyncio.subprocess.PIPE if ingest else asyncio.subprocess.DEVNULL)
+        buffer = BufferedSource(RingBuffer(size), App.config.buffer_depth, passthrough)
+        if ingest:
+            buffer.backlog = math.ceil(ingest.backlog * 1000 / Encoder.FRAME_LENGTH)
+        return Pipeline(processes, buffer, volume, ingest, App.config.normalize)
+
+    async def fill(self):
+        stdout = self.processes[-1].stdout
+
+        try:
+            if self.buffer.opus:
+                async for packet in read_ogg_packets(stdout):
+                    await self.wait_for_space()
+                    self.buffer.feed(packet)
+            else:
+                while True:
+                    data = await stdout.readexactly(Encoder.FRAME_SIZE)
+                    await self.wait_for_space()
+                    self.buffer.feed(data)
+        except (asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            self.buffer.close()
+
+    async def wait_for_space(self):
+        ring = self.buffer.ring
+        while self.backpressure and self.buffer.started is not None and len(ring) >= ring.capacity and not ring.closed:
+            await asyncio.sleep(self.backpressure_interval)
+
+    @property
+    def alive(self) -> bool:
+        return not self.buffer.eof and all(p.returncode is None for p in self.processes)
+
+    def kill(self):
+        self.task.cancel()
+        if self.ingest_task:
+            self.ingest_task.cancel()
+        self.buffer.close()
+
+        for p in self.processes:
+            if p.returncode is None:
+                try:
+                    p.kill()
+                except ProcessLookupError:
+                    pass
+
+    async def close(self):
+        self.kill()
+        await asyncio.gather(*(p.wait() for p in self.processes))
+        App.logger.debug(f"Pipeline closed. (underruns: {self.buffer.ring.underruns}, overruns: {self.buffer.ring.overruns})")
+
+
+async def spawn_processes(commands: List[List[str]], stdin: int = asyncio.subprocess.DEVNULL) -> List[Process]:
+    processes: List[Process] = []
+
+    try:
+        # 各プロセスは OS のパイプで直結し, 最後の出力だけをイベントループで読む
+        for i, command in enumerate(commands):
+            if i == len(commands) - 1:
+                read_fd, write_fd = None, asyncio.subprocess.PIPE
+            else:
+                read_fd, write_fd = os.pipe()
+
+            try:
+                processes.append(await asyncio.create_subprocess_exec(*command, stdin=stdin, stdout=write_fd))
+            except Exception:
+                if read_fd is not None:
+                    os.close(read_fd)
+                raise
+            finally:
+                if i > 0:
+                    os.close(stdin)
+                if read_fd is not None:
+                    os.close(write_fd)
+
+            stdin = read_fd
+    except Exception:
+        for p in processes:
+            p.kill()
+        raise
+
+    return processes
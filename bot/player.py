@@ -0,0 +1,337 @@
+from __future__ import annotations
+
+import asyncio
+import dataclasses
+import hashlib
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+from discord import Embed, Message, NotFound, Streaming, TextChannel, VoiceChannel, VoiceClient
+from discord.ext import commands
+
+from bot.app import App
+from bot.config import Station
+from bot.hub import BroadcastHub
+from bot.pipeline import Pipeline
+from bot.resolver import StreamResolver
+from bot.state import State
+from bot.supervisor import Supervisor
+from bot.updates import UpdateQueue
+
+
+class RadioPlayer(commands.Cog):
+    # 各モジュールは nick, avatar と次の 2 つを定義する
+    nick: str
+    avatar: str
+    # 再生するパイプラインを起動する (Supervisor が再接続のたびに呼ぶ)
+    player: Callable[[], Awaitable[Pipeline]]
+    # 番組情報を取得し続け, 告知とプレゼンスを更新する
+    update: Callable[[], Awaitable[None]]
+
+    hub: Optional[BroadcastHub] = None
+    voice_channels: List[VoiceChannel]
+    text_channel: Optional[TextChannel] = None
+    resolver: Optional[StreamResolver] = None
+    last_message: Optional[Message] = None
+    update_task: Optional[asyncio.Task] = None
+    connect_retries: int = 3
+    # Discord のボイス接続はサーバーごとに 1 つなので, どの局が使っているかを記録する
+    voice_guilds: Dict[int, RadioPlayer] = {}
+
+    def __init__(self, station: Station):
+        self.station = station
+        self.voice_clients: Dict[int, VoiceClient] = {}
+        self.__cog_name__ = station.name
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # 再接続時にも on_ready が呼ばれるため, 初回だけ起動する
+        if self.hub:
+            return
+        self.hub = BroadcastHub.get(self.station.stream_key)
+
+        App.logger.debug(f"{self.station.name}: {self.station.module.name} module loaded.")
+
+        if self.station.text_channel_id:
+            self.text_channel = App.client.get_channel(self.station.text_channel_id)
+        self.voice_channels = self.get_voice_channels(self.station.voice_channel_ids)
+
+        # プレゼンスは再接続で消えるので, 前回の内容をすぐに設定し直す
+        presence = State.get(self.station.name, "presence")
+        if presence:
+            self.set_presence(presence)
+
+        # 互いに依存しない準備は並行して進め, 再生開始までの時間を縮める
+        # 1 つが失敗しても残りの準備と更新の開始は続ける
+        results = await asyncio.gather(self.update_profile(), self.start(), self.restore_message(), *(self.join(x) for x in self.voice_channels), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                App.logger.error(f"{self.station.name}: failed to start.", exc_info=result)
+
+        self.update_task = App.client.loop.create_task(self.update())
+
+    async def start(self):
+        await self.prepare()
+        if self.resolver:
+            self.resolver.start()
+
+        if App.config.record and not self.hub.recorder:
+            from bot.recorder import Recorder
+            self.hub.recorder = Recorder(self.station.name)
+
+        # 同じストリームを共有する局の間では 1 つの Supervisor だけを動かす
+        if not self.hub.supervisor:
+            self.hub.supervisor = Supervisor(self.station.name, self.hub, self.player, self.resolver)
+            self.hub.supervisor.task = App.client.loop.create_task(self.hub.supervisor.run())
+
+    async def reconfigure(self, station: Station):
+        old, self.station = self.station, station
+
+        # まだ起動していなければ, on_ready で新しい設定がそのまま使われる
+        if not self.hub:
+            return
+
+        restart = False
+        if (old.source, old.passthrough, old.hls) == (station.source, station.passthrough, station.hls) and old.volume != station.volume:
+            App.logger.info(f"{station.name}: changing volume to {station.volume}.")
+            await self.change_volume(old)
+        elif (old.stream_key, old.hls) != (station.stream_key, station.hls):
+            App.logger.info(f"{station.name}: switching stream to {station.stream_key}.")
+            await self.switch()
+            restart = old.source != station.source
+
+        if old.text_channel_id != station.text_channel_id:
+            self.text_channel = App.client.get_channel(station.text_channel_id) if station.text_channel_id else None
+            self.last_message = None
+            State.set(station.name, "message_id", None)
+            await self.restore_message()
+            restart = True
+
+        # 接続先が変わったボイスチャンネルだけを入れ替える
+        for channel_id in set(old.voice_channel_ids) - set(station.voice_channel_ids):
+            voice_client = self.voice_clients.pop(channel_id, None)
+            if voice_client:
+                await self.disconnect(voice_client)
+        added = self.get_voice_channels([x for x in station.voice_channel_ids if x not in old.voice_channel_ids])
+        self.voice_channels = self.get_voice_channels(station.voice_channel_ids)
+        await asyncio.gather(*(self.update_nick(x) for x in added), *(self.join(x) for x in added))
+
+        # 起動中であれば, on_ready が新しい設定で更新を始める
+        if restart and self.update_task:
+            State.set(station.name, "program", None)
+            self.update_task.cancel()
+            self.update_task = App.client.loop.create_task(self.update())
+
+    async def set_volume(self, volume: float):
+        # config.json の値は書き換えず, 次に読み込み直すまでの間だけ音量を変える
+        await RadioPlayer.reconfigure(self, dataclasses.replace(self.station, volume=volume))
+
+    async def change_volume(self, old: Station):
+        # 音量もハブのキーに含まれるので, 他の局と共有しているハブには手を加えず別のハブに付け替える
+        others = [x for x in App.players.values() if x is not self and x.hub is self.hub]
+        # 音量 0 を焼き込んだ Opus からは元の音量に戻せないので, パイプラインを起動し直す
+        if others or self.station.stream_key in BroadcastHub.hubs or (old.passthrough and not old.volume):
+            await self.switch()
+            return
+
+        # 1 つの局だけが使っているハブは, パイプラインを起動し直さずにその場で音量を変える
+        self.hub.rekey(self.station.stream_key)
+        self.hub.set_volume(self.station.volume)
+
+    def guild_ids(self) -> Set[int]:
+        channels = [App.client.get_channel(x) for x in (*self.station.voice_channel_ids, self.station.text_channel_id) if x]
+        return {x.guild.id for x in channels if x and getattr(x, "guild", None)}
+
+    async def switch(self):
+        old = self.hub
+        self.hub = BroadcastHub.get(self.station.stream_key)
+        if self.resolver:
+            self.resolver.stop()
+            self.resolver = None
+
+        if self.hub is old:
+            # ハブはそのままで, 取り込み方だけが変わった場合はパイプラインを起動し直す
+            if old.supervisor:
+                old.supervisor.stop()
+                old.supervisor = None
+        else:
+            # 再生中のボイスクライアントはそのままに, 読み出すハブだけを付け替える
+            for voice_client in self.voice_clients.values():
+                voice_client.stop()
+                self.hub.subscribe(voice_client)
+            self.leave(old)
+
+        await self.start()
+
+    def leave(self, hub: BroadcastHub):
+        others = [x for x in App.players.values() if x is not self and x.hub is hub]
+        if not others:
+            if hub.supervisor:
+                hub.supervisor.stop()
+            hub.stop()
+            if hub.recorder:
+                hub.recorder.close()
+            BroadcastHub.hubs.pop(hub.key, None)
+        elif hub.supervisor and hub.supervisor.spawn == self.player:
+            # 残った局にパイプラインの起動を引き継ぐ
+            hub.supervisor.name, hub.supervisor.spawn, hub.supervisor.resolver = others[0].station.name, others[0].player, others[0].resolver
+
+    async def remove(self):
+        if self.update_task:
+            self.update_task.cancel()
+        if self.resolver:
+            self.resolver.stop()
+
+        for voice_client in self.voice_clients.values():
+            await self.disconnect(voice_client)
+        self.voice_clients.clear()
+
+        if self.hub:
+            self.leave(self.hub)
+
+        App.client.remove_cog(self.station.name)
+        App.players.pop(self.station.name, None)
+
+    async def update_profile(self):
+        try:
+            await asyncio.gather(*(self.update_nick(x) for x in self.voice_channels))
+
+            # アバターはアカウント共通なので代表の局だけが変更する
+            if self.station.primary:
+                await self.update_avatar()
+        except Exception as e:
+            logging.exception("Failed to change nickname or avatar.", exc_info=e)
+
+    async def update_nick(self, voice_channel: VoiceChannel):
+        member = voice_channel.guild.get_member(App.client.user.id)
+        if member.nick != self.nick:
+            await member.edit(nick=self.nick)
+
+    async def update_avatar(self):
+        with open(self.avatar, "rb") as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+
+        # 前回アップロードした画像のままであれば送り直さない
+        if State.get("avatar", "sha256") == digest and State.get("avatar", "hash") == App.client.user.avatar:
+            return
+
+        await App.client.user.edit(avatar=data)
+
+        State.set("avatar", "sha256", digest)
+        State.set("avatar", "hash", App.client.user.avatar)
+
+    async def restore_message(self):
+        if not self.text_channel:
+            return
+
+        # 前回のメッセージ ID が分かっていれば履歴を遡らずに済む
+        message_id = State.get(self.station.name, "message_id")
+        if message_id:
+            self.last_message = self.text_channel.get_partial_message(message_id)
+            return
+
+        async for message in self.text_channel.history(limit=10):
+            if message.author == App.client.user:
+                self.last_message = message
+                State.set(self.station.name, "message_id", message.id)
+                break
+
+    def post(self, embed: Embed):
+        # 書き込みはキューに任せ, 送信待ちの間に届いた更新は最新のものだけを送る
+        UpdateQueue.channel(self.text_channel.id).put(self.station.name, lambda: self.write(embed))
+
+    async def write(self, embed: Embed):
+        if self.last_message:
+            try:
+                await self.last_message.edit(embed=embed)
+                return
+            except NotFound:
+                pass
+
+        self.last_message = await self.text_channel.send(embed=embed)
+        State.set(self.station.name, "message_id", self.last_message.id)
+
+    def set_presence(self, name: str):
+        if self.station.primary:
+            UpdateQueue.presence().put("presence", lambda: App.client.change_presence(
+                activity=Streaming(
+                    name=name,
+                    url="https://twitch.tv/slashnephy"
+                )
+            ))
+            State.set(self.station.name, "presence", name)
+
+    def split_recording(self):
+        if self.hub and self.hub.recorder:
+            self.hub.recorder.split()
+
+    def guild_voice_clients(self, guild_id: int) -> List[VoiceClient]:
+        return [x for x in self.voice_clients.values() if x.guild.id == guild_id]
+
+    def replay(self, timestamp: float, guild_id: int) -> bool:
+        if not self.hub or not self.hub.recorder:
+            return False
+
+        # 再生位置はボイスクライアントごとに独立させ, 他のサーバーの再生には触れない
+        for voice_client in self.guild_voice_clients(guild_id):
+            source = self.hub.recorder.open(timestamp, self.hub)
+            if not source:
+                return False
+
+            voice_client.stop()
+            voice_client.play(source)
+
+        return True
+
+    def live(self, guild_id: int):
+        for voice_client in self.guild_voice_clients(guild_id):
+            voice_client.stop()
+            self.hub.subscribe(voice_client)
+
+    def get_voice_channels(self, channel_ids: List[int]) -> List[VoiceChannel]:
+        channels = []
+        for channel_id in channel_ids:
+            channel = App.client.get_channel(channel_id)
+            if channel:
+                channels.append(channel)
+            else:
+                App.logger.error(f"{self.station.name}: voice channel {channel_id} not found.")
+
+        return channels
+
+    async def join(self, voice_channel: VoiceChannel):
+        guild = voice_channel.guild
+
+        # 他の局が同じサーバーで接続していれば, その接続を奪わずに諦める
+        owner = self.voice_guilds.setdefault(guild.id, self)
+        if owner is not self or guild.voice_client:
+            App.logger.error(f"{self.station.name}: {guild} already has a voice connection ({owner.station.name}). Only one voice channel per server can be used.")
+            return
+
+        for attempt in range(self.connect_retries):
+            try:
+                voice_client = await voice_channel.connect()
+            except Exception as e:
+                App.logger.warning(f"{self.station.name}: failed to connect to {voice_channel}. ({e})")
+
+                # 接続が中途半端に残っていると再接続できないため, 自分で作った接続だけを切断してから再試行する
+                if guild.voice_client:
+                    await guild.voice_client.disconnect(force=True)
+                await asyncio.sleep(2 ** attempt)
+                continue
+
+            self.hub.subscribe(voice_client)
+            self.voice_clients[voice_channel.id] = voice_client
+            return
+
+        self.voice_guilds.pop(guild.id, None)
+        App.logger.error(f"{self.station.name}: gave up connecting to {voice_channel}.")
+
+    async def disconnect(self, voice_client: VoiceClient):
+        if self.voice_guilds.get(voice_client.guild.id) is self:
+            self.voice_guilds.pop(voice_client.guild.id)
+        await voice_client.disconnect()
+
+    async def prepare(self):
+        pass
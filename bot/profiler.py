@@ -0,0 +1,55 @@
+from __future__ import annotations
+
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Optional
+
+from aiohttp import web
+
+
+class Profiler:
+    # 全スレッドのスタックを一定間隔で記録するサンプリングプロファイラ
+    interval: float = 0.01
+    depth: int = 32
+
+    samples: Counter = Counter()
+    thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def start(cls):
+        if not cls.thread:
+            cls.thread = threading.Thread(target=cls.run, name="Profiler", daemon=True)
+            cls.thread.start()
+
+    @classmethod
+    def run(cls):
+        me = threading.get_ident()
+        names = {}
+
+        while True:
+            time.sleep(cls.interval)
+
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                if ident not in names:
+                    names = {x.ident: x.name for x in threading.enumerate()}
+
+                stack = []
+                while frame and len(stack) < cls.depth:
+                    # 行番号まで含めると種類が増え続けるので, 関数単位で数える
+                    stack.append(f"{frame.f_code.co_name} ({frame.f_code.co_filename}:{frame.f_code.co_firstlineno})")
+                    frame = frame.f_back
+
+                cls.samples[";".join([names.get(ident, str(ident)), *reversed(stack)])] += 1
+
+    @classmethod
+    async def handle(cls, request: web.Request) -> web.Response:
+        # flamegraph.pl や speedscope でそのまま読める collapsed 形式で返す
+        samples = cls.samples.most_common(int(request.query.get("limit", 500)))
+        if "reset" in request.query:
+            cls.samples.clear()
+
+        return web.Response(text="".join(f"{stack} {count}\n" for stack, count in samples))
@@ -2,124 +2,252 @@ from __future__ import annotations
 
 import asyncio
 import base64
-import logging
 import re
 import time
 from dataclasses import dataclass
-from datetime import datetime, timedelta
-from subprocess import PIPE, Popen
-from threading import Thread
-from typing import Dict, Optional
-
-import aiohttp
-import requests
-import xmltodict
-from discord import (Embed, FFmpegPCMAudio, PCMVolumeTransformer, Streaming,
-                     TextChannel, VoiceChannel, VoiceClient)
-from discord.ext import commands
+from datetime import datetime, timedelta, timezone
+from subprocess import Popen
+from typing import AsyncIterator, Dict, List, Optional
+from xml.etree import ElementTree
+from xml.etree.ElementTree import Element
+
+from aiohttp import ClientResponse
+from discord import Embed
 
 from bot.app import App
+from bot.audio import ffmpeg_output_args
+from bot.hls import HlsIngest
+from bot.metrics import Metrics
+from bot.pipeline import Pipeline
+from bot.player import RadioPlayer
+from bot.resolver import StreamResolver
+from bot.session import Session
+from bot.state import State
+
+JST = timezone(timedelta(hours=9))
 
 
-class RadikoPlayer(commands.Cog):
-    voice: VoiceClient
-    voice_channel: VoiceChannel
-    text_channel: Optional[TextChannel]
+class RadikoPlayer(RadioPlayer):
+    nick = "Radiko"
+    avatar = "resources/radiko.png"
 
     api: RadikoApiClient
 
-    @commands.Cog.listener()
-    async def on_ready(self):
-        App.logger.debug("Radiko module loaded.")
+    async def prepare(self):
+        self.api = RadikoApiClient.get(self.station.radiko_area)
+        if self.station.hls:
+            self.resolver = StreamResolver(self.station.name, f"radiko:hls:{self.station.radiko_station}", lambda: self.api.get_hls_urls(self.station.radiko_station), 60 * 60)
+        else:
+            self.resolver = StreamResolver(self.station.name, f"radiko:rtmp:{self.station.radiko_station}", lambda: self.api.get_rtmp_urls(self.station.radiko_station), 60 * 60)
+        await self.api.auth.start()
+
+    async def player(self) -> Pipeline:
+        # 認証できるまでは Supervisor のバックオフに任せて起動をやり直す
+        if not self.api.is_authenticated:
+            raise RuntimeError("Radiko is not authenticated yet.")
+
+        volume = self.station.volume
+        passthrough = self.station.passthrough
+        url = await self.resolver.resolve()
+
+        if self.station.hls:
+            pipeline = await Pipeline.spawn([
+                ["ffmpeg", "-i", "-", *ffmpeg_output_args(passthrough, volume)]
+            ], passthrough, volume, HlsIngest(url, lambda: self.api.auth_headers))
+            pipeline.upstream = url
 
-        if App.config.text_channel_id:
-            self.text_channel = App.client.get_channel(App.config.text_channel_id)
-        self.voice_channel = App.client.get_channel(App.config.voice_channel_id)
+            return pipeline
+
+        pipeline = await Pipeline.spawn([
+            ["rtmpdump", "--live", "--rtmp", url, "--swfVfy", "http://radiko.jp/apps/js/flash/myplayer-release.swf", "--pageUrl", "http://radiko.jp", "-C", "S:", "-C", "S:", "-C", "S:", "-C", f"S:{self.api.rtmp_token}"],
+            ["ffmpeg", "-i", "-", *ffmpeg_output_args(passthrough, volume)]
+        ], passthrough, volume)
+        pipeline.upstream = url
+
+        return pipeline
+
+    async def update(self):
+        schedule = RadikoSchedule(self.api, self.station.radiko_station)
+        last_program_id = State.get(self.station.name, "program")
 
+        while App.client.loop.is_running():
+            program = await schedule.get_current()
+
+            if program and program.id != last_program_id:
+                self.announce(program)
+                last_program_id = program.id
+                State.set(self.station.name, "program", program.id)
+
+                # 番組表と実際の放送がずれていないか, 切り替わりの少し後に確認する
+                await asyncio.sleep(schedule.verify_delay)
+                try:
+                    on_air = await self.api.get_on_air(self.station.radiko_station)
+                except Exception as e:
+                    App.logger.warning(f"Failed to verify Radiko program: {e}")
+                    await asyncio.sleep(schedule.retry_delay)
+                    continue
+
+                if on_air and on_air.id != program.id:
+                    schedule.override(on_air)
+                    continue
+
+            await asyncio.sleep(schedule.until_next(program))
+
+    def announce(self, program: RadikoProgram):
+        self.split_recording()
+
+        if self.text_channel:
+            embed = Embed(
+                title=program.title,
+                description=f"{program.description or ''}\n{program.info}"[:500] + "...",
+                url=program.url,
+                color=0x00a7e9,
+                timestamp=datetime.utcnow()
+            )
+            embed.set_image(
+                url=program.banner_url
+            )
+            embed.set_author(
+                name=f"{program.cast} ({program.station_name})" if program.cast else program.station_name,
+                url=f"http://radiko.jp/#!/live/{program.station_id}"
+            )
+            embed.set_footer(
+                text=f"{program.start} - {program.end} ({program.sec // 60} 分間)",
+            )
+
+            self.post(embed)
+
+        self.set_presence(f"{program.title} ({program.start} - {program.end})")
+
+class RadikoSchedule:
+    verify_delay: float = 5
+    max_sleep: float = 30 * 60
+    retry_delay: float = 30
+
+    def __init__(self, api: RadikoApiClient, station_id: str):
+        self.api = api
+        self.station_id = station_id
+        self.date: Optional[str] = None
+        self.programs: List[RadikoProgram] = []
+        self.overridden: Optional[RadikoProgram] = None
+
+    async def get_current(self) -> Optional[RadikoProgram]:
+        now = datetime.now(JST)
+
+        if self.overridden and self.overridden.ft <= now < self.overridden.to:
+            return self.overridden
+        self.overridden = None
+
+        # radiko の放送日は 5 時に切り替わる
+        date = (now - timedelta(hours=5)).strftime("%Y%m%d")
+        if date != self.date or not self.find(now):
+            try:
+                self.programs = await self.api.get_timetable(self.station_id, date)
+                self.date = date
+            except Exception as e:
+                App.logger.warning(f"Failed to fetch Radiko timetable: {e}")
+
+        program = self.find(now)
+        if program:
+            return program
+
+        # 番組表が取れない間は現在の番組だけを問い合わせ, それも失敗した場合は retry_delay 後にやり直す
         try:
-            member = self.voice_channel.guild.get_member(App.client.user.id)
-            if member.nick != "Radiko":
-                await member.edit(nick="Radiko")
-                with open("resources/radiko.png", "rb") as f:
-                    await App.client.user.edit(avatar=f.read())
+            return await self.api.get_on_air(self.station_id)
         except Exception as e:
-            logging.exception("Failed to change nickname or avatar.", exc_info=e)
+            App.logger.warning(f"Failed to fetch Radiko program: {e}")
+            return None
 
-        # バグ対応のため, 一度接続して切断する
-        await (await self.voice_channel.connect()).disconnect()
-        self.voice = await self.voice_channel.connect()
+    def find(self, now: datetime) -> Optional[RadikoProgram]:
+        for program in self.programs:
+            if program.ft <= now < program.to:
+                return program
 
-        self.api = RadikoApiClient()
-        await self.api.login()
+        return None
 
-        Thread(target=self.player).start()
-        App.client.loop.create_task(self.update())
+    def override(self, program: RadikoProgram):
+        self.overridden = program
+        self.date = None
 
-    def player(self):
-        while App.client.loop.is_running():
-            with Popen(["rtmpdump", "--live", "--rtmp", self.api.rtmp_url, "--swfVfy", "http://radiko.jp/apps/js/flash/myplayer-release.swf", "--pageUrl", "http://radiko.jp", "-C", "S:", "-C", "S:", "-C", "S:", "-C", f"S:{self.api.rtmp_token}"], stdout=PIPE) as p:
-                source = PCMVolumeTransformer(FFmpegPCMAudio(p.stdout, pipe=True), volume=App.config.volume)
-                self.voice.play(source, after=lambda _: p.kill())
-                p.wait()
+    def until_next(self, program: Optional[RadikoProgram]) -> float:
+        if not program:
+            return self.retry_delay
 
-            time.sleep(5)
+        return min(max((program.to - datetime.now(JST)).total_seconds(), 0) + 0.5, self.max_sleep)
 
-    async def update(self):
-        last_program_title = None
-        last_message = None
-        last_login = datetime.now()
+class RadikoAuth:
+    lifetime: timedelta = timedelta(hours=1)
+    margin: timedelta = timedelta(minutes=10)
+    retry_delay: float = 5
+    max_retry_delay: float = 5 * 60
 
-        async for message in self.text_channel.history(limit=10):
-            if message.author == App.client.user:
-                last_message = message
-                break
+    authkey: Optional[bytes] = None
 
-        while App.client.loop.is_running():
-            program = await self.api.get_on_air()
-
-            if program.title != last_program_title:
-                if self.text_channel:
-                    async with self.text_channel.typing():
-                        embed = Embed(
-                            title=program.title,
-                            description=f"{program.description or ''}\n{program.info}"[:500] + "...",
-                            url=program.url,
-                            color=0x00a7e9,
-                            timestamp=datetime.utcnow()
-                        )
-                        embed.set_image(
-                            url=program.banner_url
-                        )
-                        embed.set_author(
-                            name=f"{program.cast} ({program.station_name})" if program.cast else program.station_name,
-                            url=f"http://radiko.jp/#!/live/{program.station_id}"
-                        )
-                        embed.set_footer(
-                            text=f"{program.start} - {program.end} ({program.sec // 60} 分間)",
-                        )
-
-                        if last_message:
-                            await last_message.edit(embed=embed)
-                        else:
-                            last_message = await self.text_channel.send(embed=embed)
-
-                await App.client.change_presence(
-                    activity=Streaming(
-                        name=f"{program.title} ({program.start} - {program.end})",
-                        url="https://twitch.tv/slashnephy"
-                    )
-                )
-
-                if datetime.now() - last_login > timedelta(hours=3):
-                    await self.api.login()
-                    last_login = datetime.now()
-
-                last_program_title = program.title
-
-            await asyncio.sleep(30)
+    def __init__(self, area_id: str):
+        self.area_id = area_id
+        self.token: Optional[str] = None
+        self.expires = datetime.now()
+        self.task: Optional[asyncio.Task] = None
+        self.attempted = asyncio.Event()
+
+    @classmethod
+    def get_partial_key(cls, offset: int, length: int) -> str:
+        if cls.authkey is None:
+            with open("resources/authkey.jpg", "rb") as f:
+                cls.authkey = f.read()
+
+        return base64.b64encode(cls.authkey[offset:offset + length]).decode()
+
+    async def start(self):
+        # 前回のトークンがまだ有効であれば, 再起動時の認証を省く
+        if not self.token:
+            token, expires = State.get(f"radiko:{self.area_id}", "token"), State.get(f"radiko:{self.area_id}", "expires", 0)
+            if token and datetime.fromtimestamp(expires) - self.margin > datetime.now():
+                self.token, self.expires = token, datetime.fromtimestamp(expires)
+                self.attempted.set()
+        # 初回の認証も更新ループに任せ, 失敗しても再生の起動を止めずにバックオフしながらやり直す
+        if not self.task:
+            self.task = asyncio.create_task(self.refresh())
+        await self.attempted.wait()
+
+    async def refresh(self):
+        # 期限が切れる前に新しいトークンを取得しておき, 再接続時に認証を待たないようにする
+        failures = 0
+        while True:
+            if self.token:
+                await asyncio.sleep(max((self.expires - self.margin - datetime.now()).total_seconds(), 0))
+
+            try:
+                await self.login()
+                failures = 0
+            except Exception as e:
+                App.logger.warning(f"Failed to refresh Radiko token: {e}")
+                failures += 1
+            # 初回の認証を試すまでは start() で待たせる
+            self.attempted.set()
+
+            if failures:
+                await asyncio.sleep(min(self.retry_delay * 2 ** (failures - 1), self.max_retry_delay))
+
+    async def login(self):
+        session = Session.get()
+        async with session.post("https://radiko.jp/v2/api/auth1_fms", data="\r\n", headers=RadikoApiClient.headers) as response:
+            response.raise_for_status()
+            token = response.headers["X-RADIKO-AUTHTOKEN"]
+            partial_key = self.get_partial_key(int(response.headers["X-Radiko-KeyOffset"]), int(response.headers["X-Radiko-KeyLength"]))
+
+        headers = {**RadikoApiClient.headers, "X-Radiko-AuthToken": token, "X-Radiko-PartialKey": partial_key}
+        async with session.post("https://radiko.jp/v2/api/auth2_fms", data="\r\n", headers=headers) as response:
+            response.raise_for_status()
+            App.logger.info(f"Logged in Radiko with area {(await response.text()).strip()}")
+
+        # 認証が完了してから差し替えるので, 更新中も古いトークンを使い続けられる
+        self.token, self.expires = token, datetime.now() + self.lifetime
+        State.set(f"radiko:{self.area_id}", "token", self.token)
+        State.set(f"radiko:{self.area_id}", "expires", self.expires.timestamp())
 
 class RadikoApiClient:
-    headers: Dict[str, Optional[str]] = {
+    headers: Dict[str, str] = {
         "Accept": "*/*",
         "Accept-Encoding": "gzip, deflate, br",
         "Accept-Language": "ja",
@@ -134,87 +262,137 @@ class RadikoApiClient:
         "X-Requested-With": "ShockwaveFlash/26.0.0.137"
     }
 
-    @property
-    def area_id(self) -> str:
-        return App.config.radiko_area or "JP13"
+    clients: Dict[str, RadikoApiClient] = {}
 
-    @property
-    def station_id(self) -> str:
-        return App.config.radiko_station or "QRR"
+    now_ttl: float = 60
 
-    @property
-    def rtmp_url(self) -> str:
-        return xmltodict.parse(requests.get(f"https://radiko.jp/v2/station/stream_multi/{self.station_id}.xml", headers={
+    def __init__(self, area_id: str):
+        self.area_id = area_id
+        self.now_index: Dict[str, RadikoProgram] = {}
+        self.now_expires = datetime.min.replace(tzinfo=JST)
+        self.now_task: Optional[asyncio.Task] = None
+        self.auth = RadikoAuth(area_id)
+
+    @classmethod
+    def get(cls, area_id: str) -> RadikoApiClient:
+        if area_id not in cls.clients:
+            cls.clients[area_id] = RadikoApiClient(area_id)
+
+        return cls.clients[area_id]
+
+    async def get_rtmp_urls(self, station_id: str) -> List[str]:
+        async with Session.get().get(f"https://radiko.jp/v2/station/stream_multi/{station_id}.xml", headers={
             "Accept": "application/xml, text/xml, */*; q=0.01",
             "Referer": "http://radiko.jp/",
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/59.0.3071.115 Safari/537.36",
             "X-Requested-With": "XMLHttpRequest"
-        }).text)["url"]["item"][0]["#text"]
+        }) as response:
+            response.raise_for_status()
+            return [x.text for x in ElementTree.fromstring(await response.text()).findall("item") if x.text]
+
+    async def get_hls_urls(self, station_id: str) -> List[str]:
+        async with Session.get().get(f"https://radiko.jp/v3/station/stream/pc_html5/{station_id}.xml") as response:
+            response.raise_for_status()
+            root = ElementTree.fromstring(await response.text())
+
+        # タイムフリーとエリアフリーを除いたライブ配信の URL だけを使う
+        return [
+            f"{x.findtext('playlist_create_url')}?station_id={station_id}&l=15&lsid=&type=b"
+            for x in root.iter("url")
+            if x.get("timefree") == "0" and x.get("areafree") == "0" and x.findtext("playlist_create_url")
+        ]
 
     @property
     def rtmp_token(self) -> Optional[str]:
-        return self.headers.get("X-Radiko-AuthToken")
+        return self.auth.token
 
     @property
     def is_authenticated(self) -> bool:
-        return self.rtmp_token != None
-
-    async def login(self):
-        if "X-Radiko-AuthToken" in self.headers:
-            del self.headers["X-Radiko-AuthToken"]
-
-        async with aiohttp.ClientSession() as session:
-            async with session.post("https://radiko.jp/v2/api/auth1_fms", data="\r\n", headers=self.headers) as response:
-                self.headers["X-Radiko-AuthToken"] = response.headers["X-RADIKO-AUTHTOKEN"]
-
-            tmp_headers = self.headers.copy()
-            with open("resources/authkey.jpg", "rb") as f:
-                f.seek(int(response.headers["X-Radiko-KeyOffset"]))
-                tmp_headers["X-Radiko-PartialKey"] = base64.b64encode(f.read(int(response.headers["X-Radiko-KeyLength"]))).decode()
+        return self.auth.token is not None
 
-            async with session.post("https://radiko.jp/v2/api/auth2_fms", data="\r\n", headers=tmp_headers) as response:
-                App.logger.info(f"Logged in Radiko with area {(await response.text()).strip()}")
+    @property
+    def auth_headers(self) -> Dict[str, str]:
+        return {**self.headers, "X-Radiko-AuthToken": self.auth.token}
 
     @staticmethod
-    async def extract_authkey_jpg(self):
+    async def extract_authkey_jpg():
         filename: str = "player.swf"
         with open(filename, "wb") as f:
-            async with aiohttp.ClientSession() as session:
-                async with session.get("https://radiko.jp/apps/js/flash/myplayer-release.swf") as response:
-                    f.write(await response.read())
+            async with Session.get().get("https://radiko.jp/apps/js/flash/myplayer-release.swf") as response:
+                f.write(await response.read())
 
         with Popen(["swfextract", "-b", "12", "-o", "authkey.jpg", filename]) as p:
             p.wait()
 
-    async def get_on_air(self) -> Optional[Dict]:
+    async def get_on_air(self, station_id: str) -> Optional[RadikoProgram]:
         if not self.is_authenticated:
             return None
 
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"https://radiko.jp/v3/program/now/{self.area_id}.xml", headers=self.headers) as response:
-                text = await response.text()
-
-                for station in xmltodict.parse(text)["radiko"]["stations"]["station"]:
-                    if station["@id"] == self.station_id:
-                        program = station["progs"]["prog"][0]
-
-                        return RadikoProgram(
-                            station_id=station["@id"],
-                            station_name=station["name"],
-                            start=f"{program['@ftl'][0:-2]}:{program['@ftl'][-2:]}",
-                            end=f"{program['@tol'][0:-2]}:{program['@tol'][-2:]}",
-                            id=program["@id"],
-                            sec=int(program["@dur"]),
-                            title=program["title"],
-                            url=program["url"],
-                            description=program["desc"],
-                            info=re.sub("<.+?>", "", program["info"].replace("<br />", "\n")).strip() if program["info"] else None,
-                            cast=program["pfm"],
-                            banner_url=program["img"]
-                        )
+        # 同じエリアの局は 1 回の取得とパースで作った索引を共有する
+        if datetime.now(JST) >= self.now_expires:
+            if not self.now_task or self.now_task.done():
+                self.now_task = asyncio.create_task(self.fetch_now_index())
+            await asyncio.shield(self.now_task)
+
+        return self.now_index.get(station_id)
+
+    async def fetch_now_index(self):
+        index: Dict[str, RadikoProgram] = {}
+        with Metrics.timer("radiobot_metadata_poll_seconds", source="radiko_now"):
+            async with Session.get().get(f"https://radiko.jp/v3/program/now/{self.area_id}.xml", headers=self.auth_headers) as response:
+                response.raise_for_status()
+                async for program in iter_programs(response):
+                    index.setdefault(program.station_id, program)
+
+        now = datetime.now(JST)
+        self.now_index = index
+        self.now_expires = min([now + timedelta(seconds=self.now_ttl), *(x.to for x in index.values())])
+
+    async def get_timetable(self, station_id: str, date: str) -> List[RadikoProgram]:
+        with Metrics.timer("radiobot_metadata_poll_seconds", source="radiko_timetable"):
+            async with Session.get().get(f"https://radiko.jp/v3/program/station/date/{date}/{station_id}.xml", headers=self.auth_headers) as response:
+                response.raise_for_status()
+                return [x async for x in iter_programs(response)]
+
+async def iter_programs(response: ClientResponse) -> AsyncIterator[RadikoProgram]:
+    # 全体のツリーを作らず, 番組単位で要素を読み捨てながらパースする
+    parser = ElementTree.XMLPullParser(("start", "end"))
+    station_id, station_name, in_prog = "", "", False
+    # 受信待ちを除いた, パースだけにかかった時間
+    parsing = 0.0
+
+    async for chunk in response.content.iter_chunked(16384):
+        started = time.perf_counter()
+        parser.feed(chunk)
+        events = list(parser.read_events())
+        parsing += time.perf_counter() - started
+
+        for event, element in events:
+            if event == "start":
+                if element.tag == "station":
+                    station_id = element.get("id")
+                elif element.tag == "prog":
+                    in_prog = True
+            elif element.tag == "name" and not in_prog:
+                station_name = element.text
+            elif element.tag == "prog":
+                in_prog = False
+                started = time.perf_counter()
+                program = RadikoProgram.parse(station_id, station_name, element)
+                element.clear()
+                parsing += time.perf_counter() - started
+                yield program
+            elif element.tag == "station":
+                element.clear()
+
+    Metrics.observe("radiobot_parse_seconds", parsing, source="radiko")
+
+    parser.close()
 
 @dataclass
 class RadikoProgram:
+    __slots__ = ("station_id", "station_name", "start", "end", "id", "sec", "title", "url", "description", "info", "cast", "banner_url", "ft", "to")
+
     station_id: str
     station_name: str
     start: str
@@ -227,3 +405,26 @@ class RadikoProgram:
     info: Optional[str]
     cast: Optional[str]
     banner_url: str
+    ft: datetime
+    to: datetime
+
+    @staticmethod
+    def parse(station_id: str, station_name: str, program: Element) -> RadikoProgram:
+        ftl, tol, info = program.get("ftl"), program.get("tol"), program.findtext("info")
+
+        return RadikoProgram(
+            station_id=station_id,
+            station_name=station_name,
+            start=f"{ftl[0:-2]}:{ftl[-2:]}",
+            end=f"{tol[0:-2]}:{tol[-2:]}",
+            id=program.get("id"),
+            sec=int(program.get("dur")),
+            title=program.findtext("title"),
+            url=program.findtext("url"),
+            description=program.findtext("desc") or None,
+            info=re.sub("<.+?>", "", info.replace("<br />", "\n")).strip() if info else None,
+            cast=program.findtext("pfm") or None,
+            banner_url=program.findtext("img"),
+            ft=datetime.strptime(program.get("ft"), "%Y%m%d%H%M%S").replace(tzinfo=JST),
+            to=datetime.strptime(program.get("to"), "%Y%m%d%H%M%S").replace(tzinfo=JST)
+        )
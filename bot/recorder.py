@@ -0,0 +1,247 @@
+from __future__ import annotations
+
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+from array import array
+from dataclasses import dataclass
+from typing import BinaryIO, List, Optional
+
+from discord import AudioSource
+
+from bot.app import App
+from bot.audio import OPUS_SILENCE
+from bot.hub import BroadcastHub
+
+RECORD_DIR: str = "recordings"
+
+
+@dataclass
+class Segment:
+    start: float
+    path: str
+
+    @property
+    def index_path(self) -> str:
+        return f"{os.path.splitext(self.path)[0]}.idx"
+
+    def offsets(self) -> array:
+        offsets = array("I")
+        try:
+            with open(self.index_path, "rb") as f:
+                data = f.read()
+            offsets.frombytes(data[:len(data) // offsets.itemsize * offsets.itemsize])
+        except OSError:
+            pass
+
+        return offsets
+
+
+class Recorder:
+    # 1 フレーム 20ms の Opus パケットを, 長さ付きでそのまま書き出す
+    frames_per_second: int = 50
+    segment_length: float = 30 * 60
+
+    def __init__(self, name: str):
+        self.directory = os.path.join(RECORD_DIR, name)
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.segments: List[Segment] = sorted(
+            (Segment(int(os.path.splitext(x)[0]) / 1000, os.path.join(self.directory, x)) for x in os.listdir(self.directory) if x.endswith(".frames")),
+            key=lambda x: x.start
+        )
+        self.file: Optional[BinaryIO] = None
+        self.index: Optional[BinaryIO] = None
+        self.frames = 0
+        self.split_requested = False
+        self.failed = False
+        self.closed = False
+        self.dropped = 0
+
+        # ディスクへの書き込みは専用のスレッドで行い, 遅いディスクで音声スレッドを止めない
+        self.queue: queue.Queue[Optional[bytes]] = queue.Queue(maxsize=self.frames_per_second * 60)
+        self.thread = threading.Thread(target=self.run, name=f"Recorder-{name}", daemon=True)
+        self.thread.start()
+
+    def write(self, data: bytes):
+        # 音声スレッドから呼ばれるので, キューに積むだけにする
+        if self.failed or self.closed:
+            return
+
+        try:
+            self.queue.put_nowait(data)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            try:
+                data = self.queue.get(timeout=1)
+            except queue.Empty:
+                if self.closed:
+                    break
+                continue
+            if data is None:
+                break
+
+            try:
+                self.write_frame(data)
+            except OSError as e:
+                # ディスクが一杯などで書けなくなった場合は, 配信を止めずに録音だけを止める
+                App.logger.error(f"Recording to {self.directory} failed, recording disabled: {e}")
+                self.failed = True
+                break
+
+        self.close_files()
+
+    def write_frame(self, data: bytes):
+        if not self.file or self.split_requested or self.frames >= self.segment_length * self.frames_per_second:
+            self.rotate()
+
+        # 1 秒ごとにオフセットを索引に残し, 読み出し側から見えるよう書き出す
+        if self.frames % self.frames_per_second == 0:
+            self.index.write(struct.pack("<I", self.file.tell()))
+            self.index.flush()
+            self.file.flush()
+
+        self.file.write(struct.pack("<H", len(data)))
+        self.file.write(data)
+        self.frames += 1
+
+    def split(self):
+        # 番組の境界でセグメントを切り替え, 再エンコードせずに番組単位で切り出せるようにする
+        self.split_requested = True
+
+    def rotate(self):
+        self.close_files()
+
+        # ファイル名が重ならないよう, 開始時刻は前のセグメントより必ず後にする
+        start = max(time.time(), self.segments[-1].start + 0.001) if self.segments else time.time()
+        segment = Segment(start, os.path.join(self.directory, f"{int(start * 1000)}.frames"))
+        self.file = open(segment.path, "wb")
+        self.index = open(segment.index_path, "wb")
+        self.segments.append(segment)
+        self.frames = 0
+        self.split_requested = False
+
+        self.expire()
+
+    def expire(self):
+        deadline = time.time() - App.config.record_hours * 60 * 60
+        while len(self.segments) > 1 and self.segments[1].start < deadline:
+            segment = self.segments.pop(0)
+            for path in (segment.path, segment.index_path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def close(self):
+        # 積まれている分を書き終えてからスレッドを終える
+        self.closed = True
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def close_files(self):
+        for f in (self.file, self.index):
+            if f:
+                try:
+                    f.close()
+                except OSError:
+                    pass
+        self.file, self.index = None, None
+
+    def find(self, timestamp: float) -> Optional[Segment]:
+        for segment in reversed(self.segments):
+            if segment.start <= timestamp:
+                return segment
+
+        return self.segments[0] if self.segments else None
+
+    def open(self, timestamp: float, hub: BroadcastHub) -> Optional[RecordingSource]:
+        segment = self.find(timestamp)
+        if not segment:
+            return None
+
+        return RecordingSource(self, hub, segment, max(int(timestamp - segment.start), 0))
+
+
+class RecordingSource(AudioSource):
+    def __init__(self, recorder: Recorder, hub: BroadcastHub, segment: Segment, second: int):
+        self.recorder = recorder
+        self.hub = hub
+        self.sequence = hub.sequence
+        self.segment = segment
+        self.view: Optional[mmap.mmap] = None
+        self.position = 0
+
+        self.load()
+        offsets = segment.offsets()
+        if offsets:
+            self.position = offsets[min(second, len(offsets) - 1)]
+
+    def load(self):
+        if self.view:
+            self.view.close()
+            self.view = None
+
+        try:
+            with open(self.segment.path, "rb") as f:
+                if os.fstat(f.fileno()).st_size:
+                    self.view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except OSError:
+            pass
+
+    def next(self):
+        segments = self.recorder.segments
+        if self.segment in segments:
+            index = segments.index(self.segment) + 1
+            if index == len(segments):
+                # 書き込み中のセグメントに追いついたので, 伸びた分を読み直す
+                self.load()
+                return
+        else:
+            # 再生中に古いセグメントが削除された
+            index = 0
+
+        self.segment = segments[index]
+        self.position = 0
+        self.load()
+
+    def take(self) -> Optional[bytes]:
+        if not self.view or self.position + 2 > len(self.view):
+            return None
+
+        length, = struct.unpack_from("<H", self.view, self.position)
+        end = self.position + 2 + length
+        # 書き込み途中のフレームはまだ読まない
+        if end > len(self.view):
+            return None
+
+        data = self.view[self.position + 2:end]
+        self.position = end
+        return data
+
+    def read(self) -> bytes:
+        # 巻き戻し中もハブを進め, ライブの受信と録音を止めないようにする
+        self.sequence, _ = self.hub.frame(self.sequence + 1)
+
+        data = self.take()
+        if data is None:
+            self.next()
+            data = self.take()
+
+        return data if data is not None else OPUS_SILENCE
+
+    def is_opus(self) -> bool:
+        return True
+
+    def cleanup(self):
+        if self.view:
+            self.view.close()
+            self.view = None
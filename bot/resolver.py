@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import Awaitable, Callable, List, Optional
+
+from bot.app import App
+from bot.state import State
+
+
+class StreamResolver:
+    margin: float = 60
+    retry_delay: float = 30
+
+    def __init__(self, name: str, key: str, fetch: Callable[[], Awaitable[List[str]]], ttl: float):
+        self.name = name
+        self.key = key
+        self.fetch = fetch
+        self.ttl = ttl
+        self.urls: List[str] = []
+        self.index = 0
+        self.expires = 0.0
+
+        # 前回解決した URL が期限内であれば, 起動直後から使う
+        stream = State.get("streams", key)
+        if stream and stream["expires"] > time.time():
+            self.urls = stream["urls"]
+            self.expires = time.monotonic() + stream["expires"] - time.time()
+        self.task: Optional[asyncio.Task] = None
+        self.prefetch_task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if not self.prefetch_task:
+            self.prefetch_task = asyncio.create_task(self.prefetch())
+
+    def stop(self):
+        if self.prefetch_task:
+            self.prefetch_task.cancel()
+            self.prefetch_task = None
+
+    async def prefetch(self):
+        # 期限の少し前に解決し直しておき, 再接続時に HTTP を待たないようにする
+        while True:
+            await asyncio.sleep(max(self.expires - self.margin - time.monotonic(), 0))
+
+            try:
+                await self.refresh()
+            except Exception as e:
+                App.logger.warning(f"{self.name}: failed to resolve stream url: {e}")
+                await asyncio.sleep(self.retry_delay)
+
+    async def refresh(self):
+        # 同時に呼ばれても取得は 1 回にまとめる
+        if not self.task or self.task.done():
+            self.task = asyncio.create_task(self.fetch())
+
+        urls = await asyncio.shield(self.task)
+        if not urls:
+            raise ValueError("No stream url found.")
+
+        if urls != self.urls:
+            self.urls, self.index = urls, 0
+        self.expires = time.monotonic() + self.ttl
+        State.set("streams", self.key, {"urls": urls, "expires": time.time() + self.ttl})
+
+    async def resolve(self) -> str:
+        if not self.urls or time.monotonic() >= self.expires:
+            try:
+                await self.refresh()
+            except Exception:
+                # 期限切れでも解決済みの URL があればそれを使う
+                if not self.urls:
+                    raise
+
+        return self.urls[self.index % len(self.urls)]
+
+    def fail(self, url: str):
+        # 失敗した URL を使っていたなら次の候補に切り替える
+        if self.urls and self.urls[self.index % len(self.urls)] == url:
+            self.index += 1
+            App.logger.info(f"{self.name}: falling back to {self.urls[self.index % len(self.urls)]}")
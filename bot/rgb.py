@@ -1,94 +1,115 @@
 import asyncio
-import logging
-import time
+import dataclasses
+import urllib.parse
 from datetime import datetime
-from subprocess import PIPE, Popen
-from threading import Thread
-from typing import Optional
+from typing import List
 
-from discord import (Embed, PCMAudio, PCMVolumeTransformer, Streaming,
-                     TextChannel, VoiceChannel, VoiceClient)
-from discord.ext import commands
-from discord.opus import Encoder
+from discord import Embed
 
 from bot.app import App
-
-
-class RadioGardenPlayer(commands.Cog):
-    voice: VoiceClient
-    voice_channel: VoiceChannel
-    text_channel: Optional[TextChannel]
-
-    @commands.Cog.listener()
-    async def on_ready(self):
-        App.logger.debug("Rgb module loaded.")
-
-        if App.config.text_channel_id:
-            self.text_channel = App.client.get_channel(App.config.text_channel_id)
-        self.voice_channel = App.client.get_channel(App.config.voice_channel_id)
-
-        try:
-            member = self.voice_channel.guild.get_member(App.client.user.id)
-            if member.nick != "Radio Garden":
-                await member.edit(nick="Radio Garden")
-                with open("resources/rgb.png", "rb") as f:
-                    await App.client.user.edit(avatar=f.read())
-        except Exception as e:
-            logging.exception("Failed to change nickname or avatar.", exc_info=e)
-
-        # バグ対応のため, 一度接続して切断する
-        await (await self.voice_channel.connect()).disconnect()
-        self.voice = await self.voice_channel.connect()
-
-        Thread(target=self.player).start()
-        App.client.loop.create_task(self.update())
-
-    def player(self):
-        while App.client.loop.is_running():
-            with Popen(["ffmpeg", "-i", App.config.radio_garden_url, "-f", "s16le", "-ar", str(Encoder.SAMPLING_RATE), "-ac", str(Encoder.CHANNELS), "-loglevel", "warning", "pipe:1"], stdout=PIPE) as p:
-                source = PCMVolumeTransformer(PCMAudio(p.stdout), volume=App.config.volume)
-                self.voice.play(source, after=lambda _: p.kill())
-                p.wait()
-
-            time.sleep(5)
+from bot.audio import ffmpeg_output_args
+from bot.config import Station
+from bot.garden import GardenStation, RadioGardenDirectory
+from bot.hls import HlsIngest
+from bot.pipeline import Pipeline
+from bot.player import RadioPlayer
+from bot.resolver import StreamResolver
+from bot.session import Session
+from bot.state import State
+
+
+class RadioGardenPlayer(RadioPlayer):
+    nick = "Radio Garden"
+    avatar = "resources/rgb.png"
+
+    def __init__(self, station: Station):
+        self.configured_url = station.radio_garden_url
+        super().__init__(self.tuned(station))
+
+    def tuned(self, station: Station) -> Station:
+        # 検索から切り替えた局は, config.json の URL が変わるまで再起動や再読み込みをまたいで使い続ける
+        url = State.get(station.name, "tuned_url")
+        if url and State.get(station.name, "configured_url") == station.radio_garden_url:
+            return dataclasses.replace(station, radio_garden_url=url)
+
+        return station
+
+    async def reconfigure(self, station: Station):
+        self.configured_url = station.radio_garden_url
+        await super().reconfigure(self.tuned(station))
+
+    async def tune(self, entry: GardenStation):
+        State.set(self.station.name, "tuned_url", entry.url)
+        State.set(self.station.name, "configured_url", self.configured_url)
+        await super().reconfigure(dataclasses.replace(self.station, radio_garden_url=entry.url))
+
+    async def prepare(self):
+        RadioGardenDirectory.start()
+        self.resolver = StreamResolver(self.station.name, f"rgb:{self.station.radio_garden_url}", self.get_urls, 10 * 60)
+
+    async def get_urls(self) -> List[str]:
+        url = self.station.radio_garden_url
+
+        # リダイレクト先を解決しておき, ffmpeg の接続を 1 往復減らす
+        async with Session.get().get(url, allow_redirects=True) as response:
+            response.raise_for_status()
+            resolved = str(response.url)
+
+        return [resolved, url] if resolved != url else [url]
+
+    async def player(self) -> Pipeline:
+        url = await self.resolver.resolve()
+        volume = self.station.volume
+        passthrough = self.station.passthrough
+
+        # HLS のストリームは自前で取り込み, ffmpeg にはデコードだけをさせる
+        if self.station.hls or urllib.parse.urlparse(url).path.endswith(".m3u8"):
+            pipeline = await Pipeline.spawn([
+                ["ffmpeg", "-i", "-", *ffmpeg_output_args(passthrough, volume)]
+            ], passthrough, volume, HlsIngest(url))
+        else:
+            pipeline = await Pipeline.spawn([
+                ["ffmpeg", "-i", url, *ffmpeg_output_args(passthrough, volume)]
+            ], passthrough, volume)
+        pipeline.upstream = url
+
+        return pipeline
 
     async def update(self):
-        last_url = None
-        last_message = None
-
-        async for message in self.text_channel.history(limit=10):
-            if message.author == App.client.user:
-                last_message = message
-                break
+        last_url = State.get(self.station.name, "program")
+        await RadioGardenDirectory.wait()
 
         while App.client.loop.is_running():
-            url = App.config.radio_garden_url
+            url = self.station.radio_garden_url
 
             if url != last_url:
+                entry = RadioGardenDirectory.find(url)
+
                 if self.text_channel:
-                    async with self.text_channel.typing():
+                    if entry:
                         embed = Embed(
-                            description=url,
+                            title=entry.name,
+                            description=f"{entry.place}, {entry.country}",
+                            url=entry.page_url,
                             color=0x42f58d,
                             timestamp=datetime.utcnow()
                         )
-                        embed.set_author(
-                            name="Radio Garden",
-                            url="https://radio.garden"
+                    else:
+                        embed = Embed(
+                            description=url,
+                            color=0x42f58d,
+                            timestamp=datetime.utcnow()
                         )
+                    embed.set_author(
+                        name="Radio Garden",
+                        url="https://radio.garden"
+                    )
 
-                        if last_message:
-                            await last_message.edit(embed=embed)
-                        else:
-                            last_message = await self.text_channel.send(embed=embed)
+                    self.post(embed)
 
-                await App.client.change_presence(
-                    activity=Streaming(
-                        name=url,
-                        url="https://twitch.tv/slashnephy"
-                    )
-                )
+                self.set_presence(f"{entry.name} ({entry.place}, {entry.country})" if entry else url)
 
                 last_url = url
+                State.set(self.station.name, "program", url)
 
             await asyncio.sleep(30)
@@ -0,0 +1,31 @@
+from __future__ import annotations
+
+from typing import Optional
+
+import aiohttp
+
+from bot.app import App
+
+
+class Session:
+    session: Optional[aiohttp.ClientSession] = None
+
+    @classmethod
+    def get(cls) -> aiohttp.ClientSession:
+        # 全モジュールで 1 つのコネクションプールを共有し, keep-alive と DNS キャッシュを効かせる
+        if not cls.session or cls.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=App.config.http_limit,
+                limit_per_host=App.config.http_limit_per_host,
+                ttl_dns_cache=300,
+                keepalive_timeout=90
+            )
+            cls.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=30))
+
+        return cls.session
+
+    @classmethod
+    async def close(cls):
+        if cls.session and not cls.session.closed:
+            await cls.session.close()
+        cls.session = None
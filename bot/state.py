@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+from typing import Any, Dict, Optional
+
+from bot.app import App
+
+STATE_PATH: str = "state.json"
+
+
+class State:
+    # 再起動をまたいで引き継ぐ値 (最後のメッセージ, 番組, 認証トークンなど) を保持する
+    data: Dict[str, Dict[str, Any]] = {}
+    save_delay: float = 1
+    handle: Optional[asyncio.TimerHandle] = None
+
+    @classmethod
+    def load(cls):
+        try:
+            with open(STATE_PATH, "r") as f:
+                cls.data = json.load(f)
+        except (OSError, ValueError):
+            cls.data = {}
+
+    @classmethod
+    def get(cls, section: str, key: str, default: Any = None) -> Any:
+        return cls.data.get(section, {}).get(key, default)
+
+    @classmethod
+    def set(cls, section: str, key: str, value: Any):
+        if cls.get(section, key) == value:
+            return
+        cls.data.setdefault(section, {})[key] = value
+
+        # 連続した更新はまとめて 1 回だけ書き込む
+        if not cls.handle:
+            cls.handle = asyncio.get_event_loop().call_later(cls.save_delay, cls.save)
+
+    @classmethod
+    def save(cls):
+        if cls.handle:
+            cls.handle.cancel()
+            cls.handle = None
+
+        # 書き込み途中で落ちても壊れたファイルが残らないよう, 置き換えで保存する
+        try:
+            with open(f"{STATE_PATH}.tmp", "w") as f:
+                json.dump(cls.data, f, ensure_ascii=False)
+            os.replace(f"{STATE_PATH}.tmp", STATE_PATH)
+        except OSError as e:
+            App.logger.warning(f"Failed to save state: {e}")
@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from bot.app import App
+from bot.hub import BroadcastHub
+from bot.metrics import Metrics
+from bot.pipeline import Pipeline
+from bot.resolver import StreamResolver
+
+
+class Supervisor:
+    interval: float = 0.5
+    stable_after: float = 60
+    standby_after: float = 10
+    backoff_base: float = 1
+    backoff_max: float = 60
+
+    def __init__(self, name: str, hub: BroadcastHub, spawn: Callable[[], Awaitable[Pipeline]], resolver: Optional[StreamResolver] = None):
+        self.name = name
+        self.hub = hub
+        self.spawn = spawn
+        self.resolver = resolver
+        self.failures = 0
+        self.pipeline: Optional[Pipeline] = None
+        self.standby: Optional[Pipeline] = None
+        self.first_audio: Optional[float] = None
+        # 再起動をまたいで引き継ぐラウドネスの測定 (前のパイプラインのバッファを掴まないよう値だけを持つ)
+        self.loudness: Optional[Tuple[float, float, List[float]]] = None
+        self.task: Optional[asyncio.Task] = None
+        # 終了したパイプラインの統計を積算しておく
+        self.underruns = 0
+        self.overruns = 0
+        self.received = 0
+
+    async def run(self):
+        try:
+            while not App.client.is_closed():
+                self.pipeline = await self.promote() or await self.start()
+                if not self.pipeline:
+                    self.failures += 1
+                    Metrics.inc("radiobot_pipeline_restarts_total", station=self.name, reason="spawn_failed")
+                    await asyncio.sleep(self.backoff())
+                    continue
+
+                pipeline = self.pipeline
+                self.resume_loudness(pipeline)
+                self.hub.play(pipeline.source, after=lambda _, p=pipeline: App.client.loop.call_soon_threadsafe(p.kill), volume=pipeline.volume)
+                started = time.monotonic()
+
+                reason = await self.watch(pipeline, started)
+                await pipeline.close()
+                App.logger.warning(f"{self.name}: pipeline {reason}. Restarting...")
+
+                self.save_loudness(pipeline)
+
+                ring = pipeline.buffer.ring
+                self.underruns += ring.underruns
+                self.overruns += ring.overruns
+                self.received += ring.received
+                self.pipeline = None
+                Metrics.inc("radiobot_pipeline_restarts_total", station=self.name, reason=reason)
+
+                if time.monotonic() - started >= self.stable_after:
+                    self.failures = 0
+                else:
+                    self.failures += 1
+                    # すぐに切れた場合は別の配信元を試す
+                    if self.resolver and pipeline.upstream:
+                        self.resolver.fail(pipeline.upstream)
+
+                # 待機中の接続があれば即座に切り替える
+                if not self.standby or not self.standby.alive:
+                    await asyncio.sleep(self.backoff())
+        finally:
+            for pipeline in (self.pipeline, self.standby):
+                if pipeline:
+                    pipeline.kill()
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def watch(self, pipeline: Pipeline, started: float) -> str:
+        while True:
+            await asyncio.sleep(self.interval)
+
+            if self.first_audio is None and pipeline.buffer.started:
+                self.first_audio = pipeline.buffer.started - App.started
+                App.logger.info(f"{self.name}: first audio in {self.first_audio:.2f}s.")
+
+            if not pipeline.alive:
+                return "exited"
+            if pipeline.buffer.stalled(App.config.stall_timeout):
+                return "stalled"
+
+            if App.config.standby:
+                if self.standby and not self.standby.alive:
+                    await self.standby.close()
+                    self.standby = None
+                if not self.standby and time.monotonic() - started >= self.standby_after:
+                    self.standby = await self.start()
+
+    async def start(self) -> Optional[Pipeline]:
+        try:
+            return await self.spawn()
+        except Exception as e:
+            App.logger.exception(f"{self.name}: failed to spawn pipeline.", exc_info=e)
+            return None
+
+    async def promote(self) -> Optional[Pipeline]:
+        standby, self.standby = self.standby, None
+        if not standby:
+            return None
+        if not standby.alive:
+            await standby.close()
+            return None
+
+        # 待機中に溜まった古いフレームは捨てる (HLS はセグメントの間を埋める分だけ残す)
+        standby.buffer.ring.trim(standby.buffer.backlog)
+        return standby
+
+    def resume_loudness(self, pipeline: Pipeline):
+        if App.config.normalize and self.loudness:
+            from bot.loudness import LoudnessTransformer
+            if isinstance(pipeline.source, LoudnessTransformer):
+                pipeline.source.resume(self.loudness)
+
+    def save_loudness(self, pipeline: Pipeline):
+        if App.config.normalize:
+            from bot.loudness import LoudnessTransformer
+            if isinstance(pipeline.source, LoudnessTransformer):
+                self.loudness = pipeline.source.state()
+
+    def backoff(self) -> float:
+        return min(self.backoff_base * 2 ** self.failures, self.backoff_max)
@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from bot.app import App
+from bot.metrics import Metrics
+
+
+class UpdateQueue:
+    # 送信先 (チャンネル ID やプレゼンス) ごとのキュー
+    queues: Dict[str, UpdateQueue] = {}
+
+    def __init__(self, name: str, burst: int, period: float):
+        self.name = name
+        # period 秒あたり burst 回まで書き込むトークンバケット
+        self.burst = burst
+        self.period = period
+        self.tokens = float(burst)
+        self.refilled = time.monotonic()
+
+        self.pending: Dict[str, Tuple[Callable[[], Awaitable[None]], float]] = {}
+        self.event = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+        self.writes = 0
+        self.coalesced = 0
+        self.latency = 0.0
+
+    @classmethod
+    def get(cls, name: str, burst: int = 5, period: float = 5) -> UpdateQueue:
+        if name not in cls.queues:
+            cls.queues[name] = UpdateQueue(name, burst, period)
+
+        return cls.queues[name]
+
+    @classmethod
+    def channel(cls, channel_id: int) -> UpdateQueue:
+        return cls.get(f"channel:{channel_id}")
+
+    @classmethod
+    def presence(cls) -> UpdateQueue:
+        return cls.get("presence", 5, 60)
+
+    @property
+    def depth(self) -> int:
+        return len(self.pending)
+
+    def put(self, key: str, write: Callable[[], Awaitable[None]]):
+        # 書き込み待ちの更新は最新の内容だけを残し, 待ち始めた時刻は引き継ぐ
+        if key in self.pending:
+            self.coalesced += 1
+            enqueued = self.pending[key][1]
+        else:
+            enqueued = time.monotonic()
+        self.pending[key] = (write, enqueued)
+
+        self.event.set()
+        if not self.task:
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            await self.event.wait()
+            self.event.clear()
+
+            while self.pending:
+                await self.acquire()
+
+                key = next(iter(self.pending))
+                write, enqueued = self.pending.pop(key)
+
+                try:
+                    await write()
+                except Exception as e:
+                    App.logger.warning(f"{self.name}: failed to update {key}: {e}")
+
+                self.writes += 1
+                self.latency = time.monotonic() - enqueued
+                Metrics.observe("radiobot_discord_update_seconds", self.latency, queue=self.name)
+                App.logger.debug(f"{self.name}: updated {key}. (depth: {self.depth}, latency: {self.latency:.2f}s)")
+
+    async def acquire(self):
+        # Discord のレート制限に当たる前に, 自前で書き込みの間隔を空ける
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.tokens + (now - self.refilled) * self.burst / self.period, self.burst)
+            self.refilled = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+
+            await asyncio.sleep((1 - self.tokens) * self.period / self.burst)
@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import asyncio
+import os
+from typing import Dict, List, Optional
+
+from bot.app import App
+from bot.config import CONFIG_PATH, Config
+
+
+class ConfigWatcher:
+    interval: float = 5
+
+    def __init__(self):
+        self.mtime = self.stat()
+
+    @staticmethod
+    def stat() -> Optional[float]:
+        try:
+            return os.stat(CONFIG_PATH).st_mtime
+        except OSError:
+            return None
+
+    async def run(self):
+        # チャンネルからサーバーを引けるようになってから, 起動時の設定を確かめる
+        await App.client.wait_until_ready()
+        self.check_guilds(App.config)
+
+        # 更新日時だけを見て, 変更があったときにだけ読み直す
+        while not App.client.is_closed():
+            await asyncio.sleep(self.interval)
+
+            mtime = self.stat()
+            if mtime is None or mtime == self.mtime:
+                continue
+            self.mtime = mtime
+
+            try:
+                config = Config.load()
+            except Exception as e:
+                App.logger.warning(f"Failed to reload {CONFIG_PATH}: {e}")
+                continue
+
+            try:
+                await self.apply(config)
+            except Exception as e:
+                App.logger.exception(f"Failed to apply {CONFIG_PATH}.", exc_info=e)
+
+    @staticmethod
+    def check_guilds(config: Config):
+        # ボイス接続はサーバーごとに 1 つなので, 同じサーバーの局は後から接続する方が失敗する
+        guilds: Dict[int, List[str]] = {}
+        for station in config.stations:
+            for guild_id in {x.guild.id for x in map(App.client.get_channel, station.voice_channel_ids) if x}:
+                guilds.setdefault(guild_id, []).append(station.name)
+
+        for names in guilds.values():
+            if len(names) > 1:
+                App.logger.warning(f"Stations {', '.join(names)} use voice channels in the same server; only one of them can connect.")
+
+    @staticmethod
+    async def apply(config: Config):
+        if (config.token, config.prefix) != (App.config.token, App.config.prefix):
+            App.logger.warning("Changes to token or prefix take effect after restart.")
+
+        names = {x.name for x in config.stations}
+        for player in list(App.players.values()):
+            if player.station.name not in names:
+                App.logger.info(f"{player.station.name}: removed.")
+                await player.remove()
+
+        ConfigWatcher.check_guilds(config)
+
+        # バッファなどの設定は次に起動するパイプラインから使われる
+        App.config = config
+
+        # 変更のない局はそのまま再生を続ける
+        for station in config.stations:
+            player = App.players.get(station.name)
+            if not player:
+                App.logger.info(f"{station.name}: added.")
+                player = App.add_player(station)
+                if App.client.is_ready():
+                    App.client.loop.create_task(player.on_ready())
+            elif player.station != station:
+                await player.reconfigure(station)
+
+        App.logger.info(f"Reloaded {CONFIG_PATH}.")
@@ -0,0 +1,199 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import multiprocessing
+import signal
+import time
+from multiprocessing.process import BaseProcess
+from multiprocessing.shared_memory import SharedMemory
+from typing import List, Optional
+
+from discord import AudioSource
+from discord.opus import Encoder
+
+from bot.app import App
+from bot.audio import output_source
+from bot.buffer import BufferedSource
+
+HEAD, TAIL, UNDERRUNS, OVERRUNS, RECEIVED, CLOSED, LAST_RECEIVED, FLOOR = range(8)
+HEADER_SIZE = 64
+
+
+class SharedRingBuffer:
+    # 書き込み側 (ワーカー) と読み出し側 (bot) が 1 つずつの前提でロックを使わない
+    def __init__(self, capacity: int, slot_size: int = Encoder.FRAME_SIZE, name: Optional[str] = None):
+        self.capacity = capacity
+        self.slot_size = slot_size
+        self.owner = name is None
+
+        size = HEADER_SIZE + capacity * 4 + capacity * slot_size
+        # 後始末 (unlink) は作成した側だけが行う
+        self.memory = SharedMemory(name=name, create=self.owner, size=size)
+
+        buf = self.memory.buf
+        self.header = buf[:HEADER_SIZE].cast("q")
+        self.clock = buf[LAST_RECEIVED * 8:(LAST_RECEIVED + 1) * 8].cast("d")
+        self.lengths = buf[HEADER_SIZE:HEADER_SIZE + capacity * 4].cast("i")
+        self.buffer = buf[HEADER_SIZE + capacity * 4:]
+
+        if self.owner:
+            self.clock[0] = time.monotonic()
+
+    @property
+    def name(self) -> str:
+        return self.memory.name
+
+    def __len__(self) -> int:
+        return self.header[TAIL] - max(self.header[HEAD], self.header[FLOOR])
+
+    @property
+    def underruns(self) -> int:
+        return self.header[UNDERRUNS]
+
+    @property
+    def overruns(self) -> int:
+        return self.header[OVERRUNS]
+
+    @property
+    def received(self) -> int:
+        return self.header[RECEIVED]
+
+    @property
+    def last_received(self) -> float:
+        return self.clock[0]
+
+    @property
+    def closed(self) -> bool:
+        return self.header[CLOSED] != 0
+
+    def push(self, data: bytes):
+        tail = self.header[TAIL]
+
+        # 読み出し側の head には触れられないので, 溢れた場合は floor を進めて最も古いフレームを捨てる
+        # (待機中の接続が溜め込んだ古い音声ではなく, 最新の音声から再生を始められるようにする)
+        # floor は上書きする前に進め, 読み出し中のフレームが上書きされたことを読み出し側が検出できるようにする
+        if tail - max(self.header[HEAD], self.header[FLOOR]) >= self.capacity:
+            self.header[FLOOR] = tail - self.capacity + 1
+            self.header[OVERRUNS] += 1
+
+        index = tail % self.capacity
+        offset = index * self.slot_size
+        length = min(len(data), self.slot_size)
+        self.buffer[offset:offset + length] = data[:length]
+        self.lengths[index] = length
+        self.header[TAIL] = tail + 1
+
+        self.header[RECEIVED] += len(data)
+        self.clock[0] = time.monotonic()
+
+    def trim(self, length: int):
+        self.header[HEAD] = max(self.header[HEAD], self.header[TAIL] - length)
+
+    def pop(self) -> Optional[bytes]:
+        while True:
+            head = max(self.header[HEAD], self.header[FLOOR])
+            if head == self.header[TAIL]:
+                self.header[UNDERRUNS] += 1
+                return None
+
+            index = head % self.capacity
+            offset = index * self.slot_size
+            data = bytes(self.buffer[offset:offset + self.lengths[index]])
+            self.header[HEAD] = head + 1
+
+            # 読み出している間に書き込み側が追い越した場合は, 壊れているかもしれないので読み直す
+            if self.header[FLOOR] <= head:
+                return data
+
+    def close(self):
+        self.header[CLOSED] = 1
+
+    def release(self):
+        if self.owner:
+            self.memory.unlink()
+
+        # 解放後も読み出し側から参照されうるので, 閉じた空のバッファとして振る舞わせる
+        header, clock = self.header, self.clock
+        self.header, self.clock = list(header), list(clock)
+        self.header[HEAD] = self.header[TAIL]
+        self.header[CLOSED] = 1
+
+        try:
+            for view in (header, clock, self.lengths, self.buffer):
+                view.release()
+            self.memory.close()
+        except BufferError:
+            # 音声スレッドが読み出し中であれば, マッピングの解放は GC に任せる
+            pass
+
+
+class WorkerPipeline:
+    context = multiprocessing.get_context("spawn")
+
+    def __init__(self, process: BaseProcess, buffer: BufferedSource, volume: float, normalize: bool = False):
+        self.process = process
+        self.buffer = buffer
+        self.volume = volume
+        self.upstream: Optional[str] = None
+        self.source: AudioSource = output_source(buffer, volume, normalize)
+        self.released = False
+
+    @classmethod
+    async def spawn(cls, commands: List[List[str]], passthrough: bool, volume: float) -> WorkerPipeline:
+        ring = SharedRingBuffer(App.config.buffer_size)
+        process = cls.context.Process(target=work, args=(commands, passthrough, volume, ring.name, ring.capacity), daemon=True)
+
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, process.start)
+        except Exception:
+            ring.release()
+            raise
+
+        return WorkerPipeline(process, BufferedSource(ring, App.config.buffer_depth, passthrough), volume, App.config.normalize)
+
+    @property
+    def alive(self) -> bool:
+        return not self.buffer.eof and self.process.is_alive()
+
+    def kill(self):
+        self.buffer.close()
+        if self.process.is_alive():
+            self.process.terminate()
+
+    async def close(self):
+        self.kill()
+        await asyncio.get_running_loop().run_in_executor(None, self.process.join, 5)
+        if self.process.is_alive():
+            self.process.kill()
+
+        App.logger.debug(f"Worker pipeline closed. (underruns: {self.buffer.ring.underruns}, overruns: {self.buffer.ring.overruns})")
+
+        if not self.released:
+            self.released = True
+            self.buffer.ring.release()
+
+
+def work(commands: List[List[str]], passthrough: bool, volume: float, name: str, capacity: int):
+    App.logger = logging.getLogger("RadioBot")
+    ring = SharedRingBuffer(capacity, name=name)
+
+    try:
+        asyncio.run(run_worker(commands, passthrough, volume, ring))
+    finally:
+        ring.close()
+        ring.release()
+
+async def run_worker(commands: List[List[str]], passthrough: bool, volume: float, ring: SharedRingBuffer):
+    from bot.pipeline import Pipeline, spawn_processes
+
+    processes = await spawn_processes(commands)
+    pipeline = Pipeline(processes, BufferedSource(ring, 0, passthrough), volume)
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, pipeline.kill)
+
+    try:
+        await pipeline.task
+    except asyncio.CancelledError:
+        pass
+    finally:
+        await pipeline.close()